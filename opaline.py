@@ -1,69 +1,71 @@
 import os
-import math
 import time
-import struct
-import wave
-from tkinter import filedialog, Tk
-from PIL import Image, UnidentifiedImageError
+from opaline_core import (
+    MODE_ADDITIVE, MODE_KEYSTREAM, CarrierError, PayloadError, Engine,
+    parse_hex_key, carrier_length, open_reader, scan_directory, archive_size,
+    checkpoint_path, input_digest, load_checkpoint,
+)
+from opaline_core.png import image_dimensions, image_size_for
+# tkinter and Pillow are imported inside the functions that use them, so startup and WAV-only runs skip them
 
 # --- Configuration ---
 def defaults():
     return ("image.png", "audio.wav", 2) #Default image name, default file name, and audio format (1 = mono, 2 = stereo)
-# Do not change the following if you don't know what you're doing
-SIZE_STRUCT_FORMAT = '>Q'
-SIZE_BYTES_LEN = struct.calcsize(SIZE_STRUCT_FORMAT)
+# The carrier format (mode header, size header, ciphers) lives in opaline_core and is shared with Kaleidoscope
+PIPELINED = True # Overlap reading, ciphering and writing in separate threads
+PNG_WORKERS = os.cpu_count() or 1 # Threads compressing PNG data in parallel (1 = single zlib stream)
+RESUMABLE = True # Checkpoint encryptions so an interrupted one can be resumed (adds one read of the file to hash it)
+
+def make_engine():
+    # The engine that runs the menu's jobs, built from the settings above
+    return Engine(pipelined=PIPELINED, png_workers=PNG_WORKERS, resumable=RESUMABLE)
 
 # --- Loading Bar ---
-_last_progress_print_time = 0
-_animation_chars = ['|', '/', '-', '\\']
-_animation_idx = 0
-
-def _update_progress_display(percent, message):
-    global _animation_idx
-    char = _animation_chars[_animation_idx]
-    print(f"\r{message}: {char} {percent:.2f}% complete", end='', flush=True)
-    _animation_idx = (_animation_idx + 1) % len(_animation_chars)
-
-def start_progress(message="Processing..."):
-    global _last_progress_print_time, _animation_idx
-    _last_progress_print_time = time.time() # Initialize time
-    _animation_idx = 0
-    # Printing 0% at start is not really necessary
-
-def report_progress(current_item, total_items, message="Processing...", interval=0.1):
-    global _last_progress_print_time
-    if total_items == 0:
-        return
+ANIMATION_CHARS = ['|', '/', '-', '\\']
+
+class ProgressBar:
+    # Progress line for one operation. Each operation gets its own bar, so jobs running at the same
+    # time never share a timer or animation frame.
+    def __init__(self, message="Processing...", interval=0.1):
+        self.message = message
+        self.interval = interval
+        self._last_print_time = time.time()
+        self._animation_idx = 0
+        # Printing 0% at start is not really necessary
+
+    def _update_display(self, percent):
+        char = ANIMATION_CHARS[self._animation_idx]
+        print(f"\r{self.message}: {char} {percent:.2f}% complete", end='', flush=True)
+        self._animation_idx = (self._animation_idx + 1) % len(ANIMATION_CHARS)
+
+    def report(self, current_item, total_items):
+        if total_items == 0:
+            return
 
-    now = time.time()
-    # Update on first item (current_item could be 0-indexed or 1-indexed, handle current_item relative to total, assumes it is 1-indexed)
-    if current_item == 1 or current_item == total_items or \
-       (now - _last_progress_print_time >= interval):
-        percent = (current_item / total_items) * 100
-        _update_progress_display(percent, message)
-        _last_progress_print_time = now
+        now = time.time()
+        # Update on the first and last item, and otherwise at most once per interval
+        if current_item == 1 or current_item == total_items or \
+           (now - self._last_print_time >= self.interval):
+            percent = (current_item / total_items) * 100
+            self._update_display(percent)
+            self._last_print_time = now
 
-def end_progress(message="Processing..."):
-    print(f"\r{message}: Done.                            ", flush=True)
+    def end(self):
+        print(f"\r{self.message}: Done.                            ", flush=True)
 
 
 # --- Key functions ---
 def phk(key_str):
     # Parses a string of hexadecimal values into a list of integers. PHK stands for Parse Hex Key.
-    if not key_str:
-        return []
-    keys = []
+    # Returns None (after printing why) if the key is not valid hex.
     try:
-        for part in key_str.split():
-            cleaned_part = part.strip()
-            if cleaned_part:
-                keys.append(int(cleaned_part, 16))
-        if not all(0 <= k <= 255 for k in keys):
-            print("Warning: Keys should be valid hex bytes (00-FF). Some values might be invalid.")
-        return keys
+        keys = parse_hex_key(key_str)
     except ValueError:
-        print("Error: Invalid hexadecimal value in key. Using no key.")
-        return []
+        print("Error: Invalid hexadecimal value in key.")
+        return None
+    if not all(0 <= k <= 255 for k in keys):
+        print("Warning: Keys should be valid hex bytes (00-FF). Some values might be invalid.")
+    return keys
 
 # --- Conversion functions ---
 def rgb_to_hex(rgb):
@@ -87,283 +89,20 @@ def hex_to_rgb(hex_chunk):
     except ValueError:
         return 0, 0, 0
 
-# --- Conversion functions ---
-def bytes_to_rgb_list(data_bytes):
-    rgb_list = []
-    num_bytes = len(data_bytes)
-    if num_bytes == 0:
-        return rgb_list
-
-    operation_message = "Converting bytes to RGB"
-    start_progress(operation_message)
-    # Initial display for 0% or first chunk
-    report_progress(0, num_bytes, operation_message) # Report 0 bytes processed out of num_bytes
-
-    for i in range(0, num_bytes, 3):
-        chunk = data_bytes[i:i + 3]
-        if len(chunk) == 3:
-            rgb_list.append(tuple(chunk))
-        elif len(chunk) == 2:
-            rgb_list.append((chunk[0], chunk[1], 0))
-        elif len(chunk) == 1:
-            rgb_list.append((chunk[0], 0, 0))
-        
-        # Report progress: current_item is bytes processed (i + len(chunk) or similar)
-        report_progress(min(i + 3, num_bytes), num_bytes, operation_message)
-    
-    end_progress(operation_message)
-    return rgb_list
-
-def rgb_list_to_bytes(rgb_list):
-    byte_list = bytearray()
-    total_pixels = len(rgb_list)
-    if total_pixels == 0:
-        return bytes(byte_list)
-
-    operation_message = "Converting RGB to bytes"
-    start_progress(operation_message)
-    report_progress(0, total_pixels, operation_message) # Report 0 pixels processed
-
-    for idx, rgb in enumerate(rgb_list):
-        try:
-            r, g, b = [max(0, min(255, int(x))) for x in rgb[:3]]
-            byte_list.extend(bytes([r, g, b]))
-        except (ValueError, TypeError, IndexError):
-            byte_list.extend(bytes([0, 0, 0]))
-            print(f"Warning: Encountered invalid pixel data {rgb}, replacing with black.")
-        
-        report_progress(idx + 1, total_pixels, operation_message)
-
-    end_progress(operation_message)
-    return bytes(byte_list)
-
-# --- Encryption logic (Generic for byte-representable data) ---
-def cipher(data_bytes, keys, encrypting=True):
-    if not keys:
-        return data_bytes
-
-    data_len = len(data_bytes)
-    if data_len == 0:
-        return data_bytes
-        
-    processed_bytes = bytearray(data_len)
-    key_len = len(keys)
-
-    if key_len == 0: # Should be caught by 'if not keys'
-        return data_bytes
-
-    op = (lambda a, b: (a + b) % 256) if encrypting else (lambda a, b: (a - b + 256) % 256)
-    
-    op_message = "Encrypting data stream" if encrypting else "Decrypting data stream"
-    start_progress(op_message)
-    report_progress(0, data_len, op_message) # Report 0 bytes processed
-
-    # Determine update frequency for progress bar
-    update_interval_bytes = max(1, data_len // 200) # Aim for ~200 updates
-    if data_len > 1024 * 1024 : # For files > 1MB, update at least every 64KB
-         update_interval_bytes = max(update_interval_bytes, 65536)
-
-
-    for i, byte in enumerate(data_bytes):
-        processed_bytes[i] = op(byte, keys[i % key_len])
-        if (i + 1) % update_interval_bytes == 0 or (i + 1) == data_len:
-            report_progress(i + 1, data_len, op_message)
-            
-    end_progress(op_message)
-    return bytes(processed_bytes)
-
-# --- Image Handling ---
-def load_image(filepath):
-    img = None  # Initialize img to None
-    try:
-        img = Image.open(filepath)
-    except FileNotFoundError:
-        print(f"Error: Image file not found at '{filepath}'")
-        return None, None
-    except UnidentifiedImageError:
-        print(f"Error: Cannot identify image file '{filepath}'. Is it a valid image format?")
-        return None, None
-    except Exception as e: # Catch other Image.open errors
-        print(f"Error opening image '{filepath}': {e}")
-        return None, None
-
-    try:
-        img_dimensions = img.size
-
-        if img.mode == 'RGB':
-            pixels = list(img.getdata())
-        else:
-            # print(f"Image mode '{img.mode}' is not RGB. Attempting conversion...") # Less verbose
-            try:
-                img_converted = img.convert('RGB')
-                pixels = list(img_converted.getdata())
-                img_converted.close() # Close the temporary converted image
-            except Exception as e_convert:
-                print(f"\nError: Could not convert image '{filepath}' (mode: {img.mode}) to RGB: {e_convert}.")
-                # img.close() is handled in finally
-                return None, None
-        
-        # img.close() is handled in finally
-        return pixels, img_dimensions
-    except Exception as e_process:
-        print(f"Error processing image data from '{filepath}': {e_process}")
-        return None, None
-    finally:
-        if img: # Ensure img was successfully opened before trying to close
-            img.close()
-
-
-def prep_image(data_bytes, key_list, output_image_path, target_dims=None):
-    encrypted_bytes = cipher(data_bytes, key_list, encrypting=True)
-    rgb_data = bytes_to_rgb_list(encrypted_bytes)
-    required_pixels = len(rgb_data)
-
-    width, height = 0, 0
-    use_auto_resize = target_dims is None
-
-    if use_auto_resize:
-        print("Calculating optimal image size...")
-        width = max(1, math.ceil(math.sqrt(required_pixels)))
-        height = max(1, math.ceil(required_pixels / width))
-        print(f"Auto-calculated image size: {width}x{height}")
-    else:
-        width, height = target_dims
-        print(f"Using specified dimensions: {width}x{height}")
-        if required_pixels > width * height:
-            print(f"Error: Data ({required_pixels} pixels required) exceeds target image capacity ({width*height} pixels).")
-            print("Encryption aborted.")
-            return False
-
-    total_pixels = width * height
-    padding_needed = total_pixels - required_pixels
-    padded_rgb = rgb_data + [(0, 0, 0)] * padding_needed
-
-    print(f"Creating image '{output_image_path}'...")
-    try:
-        img = Image.new("RGB", (width, height))
-        img.putdata(padded_rgb)
-        img.save(output_image_path, format='PNG')
-        img.close()
-        print("Image created/updated successfully.")
-        return True
-    except Exception as e:
-        print(f"Error creating or saving image: {e}")
-        return False
-
-# --- WAV Handling ---
-def prep_wav(data_bytes, key_list, output_wav_path, sample_rate=44100, sample_width=2):
-    encrypted_bytes = cipher(data_bytes, key_list, encrypting=True)
-    if not encrypted_bytes and len(data_bytes) > 0 and key_list : # Cipher might return empty if data was empty
-        print("Error: Data became empty after ciphering. Cannot create WAV.")
-        return False
-
-    num_channels = defaults()[2]
-    bytes_per_frame = num_channels * sample_width
-
-    # Corrected padding logic
-    if bytes_per_frame > 0 : # Avoid division by zero if params are bad
-        remainder = len(encrypted_bytes) % bytes_per_frame
-        if remainder != 0:
-            padding_bytes_to_add = bytes_per_frame - remainder
-            encrypted_bytes += b'\x00' * padding_bytes_to_add # Append correct number of null bytes
-            # print(f"Padded data with {padding_bytes_to_add} zero bytes for WAV frame alignment.") # Optional
-    else:
-        print(f"Error: Invalid WAV parameters (bytes_per_frame is {bytes_per_frame}). Cannot proceed.")
-        return False
-
-
-    num_frames = len(encrypted_bytes) // bytes_per_frame if bytes_per_frame > 0 else 0
-
-    # Edge case: if encrypted_bytes is non-empty but not enough for one frame after padding
-    if len(encrypted_bytes) > 0 and num_frames == 0:
-        print(f"Warning: Data is too short for even a single WAV frame after padding (data length: {len(encrypted_bytes)}, bytes/frame: {bytes_per_frame}).")
-        # Depending on wave library, this might still error or create an empty/invalid WAV.
-        # Forcing num_frames to 0 if encrypted_bytes is effectively empty for WAV purposes.
-        if len(encrypted_bytes) < bytes_per_frame: # Ensure it's truly not enough
-             print("Resulting WAV file may be empty or invalid.")
-
-
-    print(f"Creating WAV file '{output_wav_path}'...")
-    try:
-        with wave.open(output_wav_path, 'wb') as wf:
-            wf.setnchannels(num_channels)
-            wf.setsampwidth(sample_width)
-            wf.setframerate(sample_rate)
-            wf.setnframes(num_frames)
-            wf.writeframes(encrypted_bytes)
-        print("WAV file created successfully.")
-        return True
-    except wave.Error as e:
-        print(f"Error writing WAV file: {e}")
-        # print(f"  Details: num_frames={num_frames}, len(encrypted_bytes)={len(encrypted_bytes)}, bytes_per_frame={bytes_per_frame}")
-        return False
-    except Exception as e:
-        print(f"An unexpected error occurred during WAV creation: {e}")
-        return False
-
-def load_wav(filepath):
-    try:
-        with wave.open(filepath, 'rb') as wf:
-            print(f"Loading WAV: {wf.getnchannels()} channels, {wf.getframerate()} Hz, {wf.getsampwidth()} bytes/sample")
-            frames = wf.readframes(wf.getnframes())
-            return frames
-    except FileNotFoundError:
-        print(f"Error: WAV file not found at '{filepath}'")
-        return None
-    except wave.Error as e:
-        print(f"Error reading WAV file '{filepath}': {e}. Is it a valid WAV file?")
-        return None
-    except Exception as e:
-        print(f"Error opening or reading WAV file '{filepath}': {e}")
-        return None
-
 # --- Core encryption/decryption Logic ---
-def encrypt_file(target_data_file, output_media_path, media_type, key_str):
-    if not target_data_file:
-        print("Error: No target data file selected for encryption input. Use 'Select Target' first.")
-        return
-
-    print(f"Attempting to encrypt data file: {target_data_file}")
-    try:
-        with open(target_data_file, 'rb') as f:
-            file_bytes = f.read()
-        original_size = len(file_bytes)
-        print(f"Read {original_size} bytes from the file.")
-        if original_size == 0:
-            print("Warning: Target file is empty. Encrypted media will represent an empty file.")
-    except FileNotFoundError:
-        print(f"Error: Target data file '{target_data_file}' not found.")
-        return
-    except Exception as e:
-        print(f"Error reading data file: {e}")
-        return
-
-    keys = phk(key_str)
-
-    try:
-        size_bytes = struct.pack(SIZE_STRUCT_FORMAT, original_size)
-    except struct.error as e:
-        print(f"Error packing file size ({original_size}): {e}. Cannot proceed.")
-        return
-    
-    data_to_process = size_bytes + file_bytes
-    success = False
-    
-    print(f"\nStarting file encryption to {media_type.upper()}...")
-    start_time = time.time()
-
+def _media_params(media_type, output_media_path):
+    # Asks for the carrier settings of a media type. Returns writer parameters, or None for an unknown type.
+    params = {}
     if media_type == 'png':
-        target_dims = None
         if os.path.exists(output_media_path):
             preserve = input(f"Output image '{output_media_path}' exists. Preserve its dimensions? (y/n, default = n): ").strip().lower()
             if preserve == 'y':
                 print("Attempting to use existing image dimensions...")
-                _, existing_dims = load_image(output_media_path) # load_image handles its own prints
-                if existing_dims:
-                    target_dims = existing_dims
-                else:
+                try:
+                    params['target_dims'] = image_dimensions(output_media_path)
+                except CarrierError as e:
+                    print(f"Error: {e}")
                     print("Could not load existing image dimensions. Using auto-resize.")
-        success = prep_image(data_to_process, keys, output_media_path, target_dims)
 
     elif media_type == 'wav':
         sr, sw = 44100, 2 # Defaults
@@ -380,94 +119,223 @@ def encrypt_file(target_data_file, output_media_path, media_type, key_str):
                 raise ValueError("Sample rate must be positive")
 
         except ValueError as e:
-            print(f"Invalid input: {e}. Using defaults ({sr} Hz, {sw*8}-bit).")
-            # sr, sw already set to defaults
-        
-        success = prep_wav(data_to_process, keys, output_media_path, sample_rate=sr, sample_width=sw)
+            print(f"Invalid input: {e}. Using defaults (44100 Hz, 16-bit).")
+            sr, sw = 44100, 2
+        params.update(sample_rate=sr, sample_width=sw, channels=defaults()[2])
 
     else:
         print(f"Error: Unknown media type '{media_type}' for encryption.")
+        return None
+    return params
+
+def _find_resumable(target_data_file, output_media_path, media_type):
+    # Looks for an interrupted encryption of this file into this output and asks whether to resume it.
+    # Returns (record or None, input digest or None).
+    if not os.path.exists(checkpoint_path(output_media_path)):
+        return None, None
+    print("Found an interrupted encryption for this output. Checking that it matches the target file...")
+    digest = input_digest(target_data_file)
+    record = load_checkpoint(output_media_path, digest)
+    if record is None or record['media_type'] != media_type:
+        print("It was made from a different file or format and will be replaced.")
+        return None, digest
+    saved = record['offset'] / carrier_length(record['input_size']) * 100
+    answer = input(f"{saved:.2f}% of it is saved. Resume it? (y/n, default = y): ").strip().lower()
+    if answer == 'n':
+        return None, digest
+    return record, digest
+
+
+def encrypt_file(target_data_file, output_media_path, media_type, key_str, mode=MODE_ADDITIVE, engine=None):
+    engine = engine or make_engine()
+    if not target_data_file:
+        print("Error: No target data file selected for encryption input. Use 'Select Target' first.")
         return
 
-    end_time = time.time()
-    if success:
-        print(f"File encryption finished in {end_time - start_time:.4f} seconds.")
+    print(f"Attempting to encrypt data file: {target_data_file}")
+    try:
+        original_size = os.path.getsize(target_data_file)
+        print(f"Target file is {original_size} bytes.")
+        if original_size == 0:
+            print("Warning: Target file is empty. Encrypted media will represent an empty file.")
+    except FileNotFoundError:
+        print(f"Error: Target data file '{target_data_file}' not found.")
+        return
+    except OSError as e:
+        print(f"Error reading data file: {e}")
+        return
+
+    if mode == MODE_KEYSTREAM and not key_str:
+        print("Error: Keystream mode requires a passphrase.")
+        return
+    if mode == MODE_ADDITIVE and phk(key_str) is None:
+        return
+
+    record, digest = None, None
+    if engine.resumable:
+        try:
+            record, digest = _find_resumable(target_data_file, output_media_path, media_type)
+        except OSError as e:
+            print(f"Error reading data file: {e}")
+            return
+
+    if record is not None:
+        params = {}  # The carrier settings and cipher mode come from the interrupted run
     else:
+        params = _media_params(media_type, output_media_path)
+        if params is None:
+            return
+
+    print(f"\nStarting file encryption to {media_type.upper()}...")
+    bar = ProgressBar("Encrypting data stream")
+    try:
+        if media_type == 'png':
+            layout = record['params'] if record else params
+            width, height = image_size_for(carrier_length(original_size), layout.get('target_dims'))
+            print(f"Image size: {width}x{height}")
+        print(f"{'Resuming' if record else 'Creating'} {media_type.upper()} file '{output_media_path}'...")
+        job = engine.encode(target_data_file, media_type, output_media_path, key_str, mode, params,
+                            record=record, digest=digest, progress=bar.report)
+        bar.end()
+    except KeyboardInterrupt:
+        print("\n\nEncryption interrupted (Ctrl+C).")
+        if engine.resumable:
+            print("Progress up to the last checkpoint is saved. Encrypt the same file to the same output again to resume.")
+        return
+    except (CarrierError, PayloadError, ValueError, OSError) as e:
+        print(f"\nError: {e}")
         print("File encryption failed.")
+        return
+
+    print(f"File encryption finished in {job.elapsed:.4f} seconds.")
 
 
-def decrypt_file(input_media_path, media_type, key_str, output_filepath):
+def decrypt_file(input_media_path, media_type, key_str, output_filepath, engine=None):
+    engine = engine or make_engine()
     if not output_filepath:
         print("Output filename cannot be empty. Aborting decryption.")
         return
 
+    if media_type not in ('png', 'wav'):
+        print(f"Error: Unknown media type '{media_type}' for decryption.")
+        return
+
     print(f"\nAttempting decryption from {media_type.upper()} '{input_media_path}' to new file '{output_filepath}'...")
-    start_time = time.time()
+    bar = ProgressBar("Decrypting data stream")
 
-    keys = phk(key_str)
-    raw_data_bytes = None
+    try:
+        if media_type == 'wav':
+            with open_reader('wav', input_media_path) as reader:
+                print(f"Loading WAV: {reader.channels} channels, {reader.sample_rate} Hz, {reader.sample_width} bytes/sample")
+        job = engine.decode(input_media_path, media_type, output_filepath, key_str, progress=bar.report)
+        bar.end()
+    except CarrierError as e:
+        print(f"Error: {e}")
+        print("File decryption failed (could not load media data).")
+        return
+    except (PayloadError, ValueError) as e:
+        print(f"\nError: {e}")
+        print(" Possible reasons: incorrect key, corrupted file, file not created by this program, or incorrect media type selected.")
+        return
+    except OSError as e:
+        print(f"\nError writing decrypted file '{output_filepath}': {e}")
+        return
 
-    if media_type == 'png':
-        pixels, _ = load_image(input_media_path) # load_image handles its prints/errors
-        if pixels is None:
-            print("File decryption failed (could not load image pixels).")
-            return
-        raw_data_bytes = rgb_list_to_bytes(pixels) # This shows progress
+    if job.written < job.expected:
+        print(f"Warning: Actual data length ({job.written}) is less than expected original size ({job.expected}).")
+        print("File might be incomplete or corrupted.")
+
+    print(f"Finished writing {job.written} bytes of decrypted data to '{output_filepath}' in {job.elapsed:.4f} seconds.")
 
-    elif media_type == 'wav':
-        raw_data_bytes = load_wav(input_media_path) # load_wav handles its prints/errors
-        if raw_data_bytes is None:
-            print("File decryption failed (could not load WAV data).")
-            return
-    else:
-        print(f"Error: Unknown media type '{media_type}' for decryption.")
-        return
 
-    if not raw_data_bytes: # Should be caught by earlier checks
-        print("Error: Failed to extract raw byte data from the media file.")
+def encrypt_directory(directory, output_media_path, media_type, key_str, mode=MODE_ADDITIVE, engine=None):
+    # Packs every file under `directory` into one carrier as an archive with an index at the start.
+    engine = engine or make_engine()
+    if mode == MODE_KEYSTREAM and not key_str:
+        print("Error: Keystream mode requires a passphrase.")
+        return
+    if mode == MODE_ADDITIVE and phk(key_str) is None:
         return
 
-    all_decrypted_bytes = cipher(raw_data_bytes, keys, encrypting=False) # This shows progress
+    print(f"Scanning folder: {directory}")
+    try:
+        entries = scan_directory(directory)
+    except OSError as e:
+        print(f"Error reading folder: {e}")
+        return
+    if not entries:
+        print("Error: The folder contains no files.")
+        return
+    archive_len = archive_size(entries)
+    print(f"Found {len(entries)} files, {archive_len} bytes including the index.")
 
-    if len(all_decrypted_bytes) < SIZE_BYTES_LEN:
-        print(f"Error: Decrypted data stream is too short ({len(all_decrypted_bytes)} bytes) to contain file size info ({SIZE_BYTES_LEN} bytes).")
-        print(" Possible reasons: incorrect key, corrupted file, file not created by this program, or incorrect media type selected.")
+    params = _media_params(media_type, output_media_path)
+    if params is None:
         return
 
-    # print("Extracting original file size and data...") # Quick operation
+    print(f"\nStarting archive encryption to {media_type.upper()}...")
+    bar = ProgressBar("Encrypting archive")
     try:
-        size_bytes = all_decrypted_bytes[:SIZE_BYTES_LEN]
-        original_size = struct.unpack(SIZE_STRUCT_FORMAT, size_bytes)[0]
-        # print(f"Extracted original file size: {original_size} bytes.") # Can be verbose
+        if media_type == 'png':
+            width, height = image_size_for(carrier_length(archive_len), params.get('target_dims'))
+            print(f"Image size: {width}x{height}")
+        print(f"Creating {media_type.upper()} file '{output_media_path}'...")
+        job = engine.encode_directory(directory, media_type, output_media_path, key_str, mode, params,
+                                      progress=bar.report, entries=entries)
+        bar.end()
+    except (CarrierError, PayloadError, OSError) as e:
+        print(f"\nError: {e}")
+        print("Archive encryption failed.")
+        return
+
+    print(f"Archive encryption finished in {job.elapsed:.4f} seconds.")
 
-        extracted_file_data = all_decrypted_bytes[SIZE_BYTES_LEN:]
 
-        if len(extracted_file_data) < original_size:
-            print(f"Warning: Actual data length ({len(extracted_file_data)}) is less than expected original size ({original_size}).")
-            print("File might be incomplete or corrupted.")
-            final_file_data = extracted_file_data
-        else:
-            final_file_data = extracted_file_data[:original_size]
+def extract_archive(input_media_path, media_type, key_str, out_dir, member_name=None, engine=None):
+    # Extracts one member (or all of them when member_name is None) from an archive carrier.
+    # Only the index and the chosen members are read; PNG and WAV carriers seek straight to the data.
+    engine = engine or make_engine()
+    if media_type not in ('png', 'wav'):
+        print(f"Error: Unknown media type '{media_type}' for decryption.")
+        return
 
-    except struct.error as e:
-        print(f"Error unpacking file size: {e}. Media file data may be corrupted, the key might be wrong, or it's not an Opaline file.")
+    bar = ProgressBar("Extracting archive")
+    try:
+        job = engine.extract(input_media_path, media_type, key_str, out_dir,
+                             None if member_name is None else [member_name], progress=bar.report)
+        bar.end()
+    except CarrierError as e:
+        print(f"Error: {e}")
+        print("Archive extraction failed (could not load media data).")
+        return
+    except (PayloadError, ValueError) as e:
+        print(f"\nError: {e}")
+        print(" Possible reasons: incorrect key, corrupted file, or the file is not an Opaline archive.")
         return
-    except Exception as e:
-        print(f"An unexpected error occurred during data extraction: {e}")
+    except OSError as e:
+        print(f"\nError writing extracted file: {e}")
         return
 
-    print(f"Attempting to write {len(final_file_data)} bytes to new file '{output_filepath}'...")
+    print(f"Extracted {len(job.members)} file(s) to '{out_dir}' in {job.elapsed:.4f} seconds.")
+
+
+def list_archive(input_media_path, media_type, key_str, engine=None):
+    # Returns the archive's members, or None after printing an error.
+    engine = engine or make_engine()
     try:
-        with open(output_filepath, 'wb') as f:
-            f.write(final_file_data)
-        end_time = time.time()
-        print(f"Finished writing decrypted data to '{output_filepath}' in {end_time - start_time:.4f} seconds.")
-    except Exception as e:
-        print(f"Error writing decrypted file '{output_filepath}': {e}")
+        return engine.list_archive(input_media_path, media_type, key_str)
+    except CarrierError as e:
+        print(f"Error: {e}")
+    except (PayloadError, ValueError) as e:
+        print(f"\nError: {e}")
+        print(" Possible reasons: incorrect key, corrupted file, or the file is not an Opaline archive.")
+    return None
 
 
 # --- File Selection ---
 def select_target_file():
+    from tkinter import filedialog, Tk
+
     print("\nPlease select the target file (file to encrypt or media file to decrypt)...")
     root = Tk()
     root.withdraw()
@@ -482,6 +350,86 @@ def select_target_file():
         print("\nNo file selected; target remains unset.")
         return None
 
+def select_target_folder():
+    from tkinter import filedialog, Tk
+
+    print("\nPlease select the folder to archive...")
+    root = Tk()
+    root.withdraw()
+    root.attributes('-topmost', True)
+    selected_path = filedialog.askdirectory(title="Select Folder to Archive")
+    root.destroy()
+
+    if selected_path:
+        print(f"\nFolder set to: {selected_path}")
+        return selected_path
+    print("\nNo folder selected.")
+    return None
+
+
+def choose_output_media():
+    # Asks for the carrier format and filename. Returns (media_type, path), or (None, None) to go back.
+    default_img_name, default_wav_name, _ = defaults()
+    print("-" * 60)
+    print("Choose an output format: ")
+    print("  1. Image (png)")
+    print("  2. Audio (wav)")
+    print("  3. Back")
+    print("-" * 60)
+
+    media_choice_str = input("Choose output format (default = image): ")
+    media_choice = 1 # Default to image
+    if media_choice_str:
+        try:
+            media_choice = int(media_choice_str)
+        except ValueError:
+            print("\nInvalid choice. Defaulting to image.")
+
+    if media_choice == 1:
+        return 'png', input(
+            f"Enter output PNG filename (blank uses '{default_img_name}'): ").strip() or default_img_name
+    elif media_choice == 2:
+        return 'wav', input(
+            f"Enter output WAV filename (blank uses '{default_wav_name}'): ").strip() or default_wav_name
+    elif media_choice != 3:
+        print("\nInvalid format choice. Returning to main menu.")
+        input("\nPress Enter to continue...")
+    return None, None
+
+
+def choose_cipher():
+    # Asks for the cipher mode and key. Returns (mode, key).
+    print("-" * 60)
+    print("Choose a cipher mode: ")
+    print("  1. Hex key (legacy)")
+    print("  2. Passphrase keystream (stronger, about half the speed of a hex key)")
+    print("-" * 60)
+
+    mode_choice_str = input("Choose cipher mode (default = hex key): ").strip()
+    cipher_mode = MODE_KEYSTREAM if mode_choice_str == '2' else MODE_ADDITIVE
+
+    if cipher_mode == MODE_KEYSTREAM:
+        key = input("Enter passphrase: ")
+    else:
+        key = input("Enter optional encryption key (hex values separated by spaces, e.g., '1F A0 33'), or leave blank for no encryption: ").strip()
+    return cipher_mode, key
+
+
+def target_media_type(target_file):
+    # Returns 'png' or 'wav' from the target's extension, or None after printing an error.
+    if not target_file:
+        print("Error: No target file selected.")
+        print("Please use option 1 first to select the .png or .wav file you want to decrypt.")
+        return None
+
+    _, ext = os.path.splitext(target_file)
+    ext = ext.lower()[1:]
+    if ext not in ['png', 'wav']:
+        print(f"Error: Cannot determine supported media type from extension '{ext}'.")
+        print(" Please select a png or wav file that you know was created by Opaline.")
+        return None
+    return ext
+
 # --- User Interface ---
 def display_ui(target_data_file):
     os.system('cls' if os.name == 'nt' else 'clear')
@@ -493,17 +441,19 @@ def display_ui(target_data_file):
     print("  1. Select target")
     print("  2. Encrypt target")
     print("  3. Decrypt target")
-    print("  4. Exit")
+    print("  4. Archive a folder")
+    print("  5. Extract from archive target")
+    print("  6. Exit")
     print("-" * 60)
 
 
 def main():
     target_file = None
-    default_img_name, default_wav_name, _ = defaults() # Use tuple unpacking
+    engine = make_engine()
 
     while True:
         display_ui(target_file)
-        choice = input("Enter choice (1-4): ")
+        choice = input("Enter choice (1-6): ")
 
         try:
             n = int(choice)
@@ -521,80 +471,83 @@ def main():
                     input("\nPress Enter to continue...")
                     continue
 
-                print("-" * 60)
-                print("Choose an output format: ")
-                print("  1. Image (png)")
-                print("  2. Audio (wav)")
-                print("  3. Back")
-                print("-" * 60)
-
-                media_choice_str = input("Choose output format (default = image): ")
-                media_choice = 1 # Default to image
-                if media_choice_str:
-                    try:
-                        media_choice = int(media_choice_str)
-                    except ValueError:
-                        print("\nInvalid choice. Defaulting to image.")
-                
-                output_media_path = ""
-                media_type = ""
-
-                if media_choice == 1:
-                    media_type = 'png'
-                    output_media_path = input(
-                        f"Enter output PNG filename (blank uses '{default_img_name}'): ").strip() or default_img_name
-                elif media_choice == 2:
-                    media_type = 'wav'
-                    output_media_path = input(
-                        f"Enter output WAV filename (blank uses '{default_wav_name}'): ").strip() or default_wav_name
-                elif media_choice == 3:
+                media_type, output_media_path = choose_output_media()
+                if media_type is None:
                     continue
-                else:
-                     print("\nInvalid format choice. Returning to main menu.")
-                     input("\nPress Enter to continue...")
-                     continue
-
-                key = input("Enter optional encryption key (hex values separated by spaces, e.g., '1F A0 33'), or leave blank for no encryption: ").strip()
-                encrypt_file(target_file, output_media_path, media_type, key)
+                cipher_mode, key = choose_cipher()
+                encrypt_file(target_file, output_media_path, media_type, key, cipher_mode, engine)
                 input("\nPress Enter to continue...")
 
             elif n == 3:
-                if not target_file:
-                    print("Error: No target file selected.")
-                    print("Please use option 1 first to select the .png or .wav file you want to decrypt.")
+                media_type = target_media_type(target_file)
+                if media_type is None:
                     input("\nPress Enter to continue...")
                     continue
 
-                _, ext = os.path.splitext(target_file)
-                ext = ext.lower()[1:]
-                if ext not in ['png', 'wav']:
-                    print(f"Error: Cannot determine supported media type from extension '{ext}'.")
-                    print(" Please select a png or wav file that you know was created by Opaline.")
-                    input("\nPress Enter to continue...")
-                    continue
-                
-                media_type = ext
-                key = input("Enter optional decryption key used during encryption (hex values separated by spaces), or leave blank if no key was used: ").strip()
+                # The cipher mode is read from the file header, so one prompt covers hex keys and passphrases
+                key = input("Enter the key used during encryption (hex values separated by spaces, or the passphrase for keystream mode), or leave blank if no key was used: ")
                 print("\nThis next step is important.\nYou must enter the file name and the correct file extension.")
                 out_file = input(
                     "Enter desired filename for the decrypted file (default = archive.zip): ").strip()
 
                 if not out_file:
                     out_file = "archive.zip"
-                    decrypt_file(target_file, media_type, key, out_file)
+                    decrypt_file(target_file, media_type, key, out_file, engine)
                 else:
-                    decrypt_file(target_file, media_type, key, out_file)
+                    decrypt_file(target_file, media_type, key, out_file, engine)
                 input("\nPress Enter to continue...")
-            
+
             elif n == 4:
+                folder = select_target_folder()
+                if not folder:
+                    input("\nPress Enter to continue...")
+                    continue
+
+                media_type, output_media_path = choose_output_media()
+                if media_type is None:
+                    continue
+                cipher_mode, key = choose_cipher()
+                encrypt_directory(folder, output_media_path, media_type, key, cipher_mode, engine)
+                input("\nPress Enter to continue...")
+
+            elif n == 5:
+                media_type = target_media_type(target_file)
+                if media_type is None:
+                    input("\nPress Enter to continue...")
+                    continue
+
+                key = input("Enter the key used during encryption (hex values separated by spaces, or the passphrase for keystream mode), or leave blank if no key was used: ")
+                members = list_archive(target_file, media_type, key, engine)
+                if members is None:
+                    input("\nPress Enter to continue...")
+                    continue
+
+                print("-" * 60)
+                for i, member in enumerate(members, 1):
+                    print(f"  {i}. {member.name} ({member.length} bytes)")
+                print("-" * 60)
+                pick = input("Enter a file number to extract, or leave blank to extract everything: ").strip()
+                member_name = None
+                if pick:
+                    if not pick.isdigit() or not 1 <= int(pick) <= len(members):
+                        print("\nInvalid file number. Returning to main menu.")
+                        input("\nPress Enter to continue...")
+                        continue
+                    member_name = members[int(pick) - 1].name
+
+                out_dir = input("Enter the folder to extract into (default = extracted): ").strip() or "extracted"
+                extract_archive(target_file, media_type, key, out_dir, member_name, engine)
+                input("\nPress Enter to continue...")
+
+            elif n == 6:
                 print("Exiting Opaline. Goodbye! :)")
                 break   
             else:
-                print(f"\nInvalid choice ({n}). Please enter a number between 1 and 4.")
+                print(f"\nInvalid choice ({n}). Please enter a number between 1 and 6.")
                 input("\nPress Enter to continue...")
 
         except ValueError:
-            print("\nInvalid input. Please enter a number (1-4).")
+            print("\nInvalid input. Please enter a number (1-6).")
             input("Press Enter to continue...")
         except KeyboardInterrupt:
             print("\n\nOperation cancelled by user (Ctrl+C). Exiting.")
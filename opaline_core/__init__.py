@@ -0,0 +1,23 @@
+# Shared codec core for Opaline and Kaleidoscope: the payload format (mode header, size header,
+# ciphers), the streaming encode/decode pipeline, checkpointed (resumable) encoding, the multi-file
+# archive format, container backends for PNG, WAV and MP4, and the Engine that runs jobs on them.
+
+from .payload import (
+    SIZE_STRUCT_FORMAT, SIZE_BYTES_LEN,
+    HEADER_MAGIC, HEADER_LEN, SALT_LEN, VERIFIER_LEN, MODE_ADDITIVE, MODE_KEYSTREAM,
+    CHUNK_SIZE, PayloadError,
+    parse_hex_key, derive_stream_key, additive_cipher, keystream, keystream_cipher,
+    build_header, parse_header, open_header, carrier_length, encode_stream, decode_stream, PayloadReader,
+)
+from .carrier import (
+    CarrierError, CarrierWriter, CarrierReader, BACKENDS, register_backend, open_writer, open_reader,
+)
+from .pipeline import PIPELINE_DEPTH, run_pipeline
+from .resume import (
+    CHECKPOINT_SUFFIX, checkpoint_path, input_digest, load_checkpoint, discard_checkpoint, encode_resumable,
+)
+from .archive import (
+    ArchiveMember, ArchiveSource, scan_directory, archive_size, read_index, member_path, extract_member,
+)
+from .engine import Engine, Job
+# The png, wav and mp4 backend modules are imported on first use by open_writer/open_reader
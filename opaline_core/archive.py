@@ -0,0 +1,165 @@
+import os
+import zlib
+import struct
+from collections import namedtuple
+
+from .payload import SIZE_BYTES_LEN, PayloadError
+
+# Archive layout, stored as the file data of an ordinary carrier:
+#   ARCHIVE_MAGIC, index length (>I), index entries, then member data back to back.
+# Each entry is data offset (>Q, from the start of the archive), length (>Q), CRC-32 (>I), name length
+# (>H) and the UTF-8 name with '/' separators. The index sits right after the size header, so one
+# member is extracted by reading the index and seeking straight to that member's data.
+ARCHIVE_MAGIC = b'OPAR'
+ARCHIVE_HEADER_FORMAT = '>4sI'
+ARCHIVE_HEADER_LEN = struct.calcsize(ARCHIVE_HEADER_FORMAT)
+ENTRY_FORMAT = '>QQIH'
+ENTRY_LEN = struct.calcsize(ENTRY_FORMAT)
+COPY_CHUNK_SIZE = 1 << 20
+
+ArchiveMember = namedtuple('ArchiveMember', ['name', 'offset', 'length', 'crc32'])
+
+
+def _file_crc32(path):
+    crc = 0
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(COPY_CHUNK_SIZE), b''):
+            crc = zlib.crc32(block, crc)
+    return crc
+
+
+def scan_directory(directory):
+    # Returns [(ArchiveMember, path)] for every file under `directory`, sorted by name. This first pass
+    # reads each file once for its checksum so the index can be written ahead of the data.
+    found = []
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for filename in sorted(files):
+            path = os.path.join(root, filename)
+            name = os.path.relpath(path, directory).replace(os.sep, '/')
+            found.append((name, path))
+
+    index_len = sum(ENTRY_LEN + len(name.encode('utf-8')) for name, _ in found)
+    offset = ARCHIVE_HEADER_LEN + index_len
+    entries = []
+    for name, path in found:
+        length = os.path.getsize(path)
+        entries.append((ArchiveMember(name, offset, length, _file_crc32(path)), path))
+        offset += length
+    return entries
+
+
+def build_index(members):
+    index = b''.join(
+        struct.pack(ENTRY_FORMAT, m.offset, m.length, m.crc32, len(m.name.encode('utf-8'))) + m.name.encode('utf-8')
+        for m in members
+    )
+    return struct.pack(ARCHIVE_HEADER_FORMAT, ARCHIVE_MAGIC, len(index)) + index
+
+
+def archive_size(entries):
+    # Total archive bytes for scan_directory() entries.
+    members = [m for m, _ in entries]
+    return len(build_index(members)) + sum(m.length for m in members)
+
+
+class ArchiveSource:
+    # File-like object producing the archive bytes: the index, then each member streamed from disk in
+    # turn. Members that changed since scan_directory() raise PayloadError rather than corrupt the index.
+    def __init__(self, entries):
+        self._head = build_index([m for m, _ in entries])
+        self._entries = list(entries)
+        self._current = None
+        self._member = None
+        self._remaining = 0
+        self._crc = 0
+
+    def _next_member(self):
+        if not self._entries:
+            return False
+        self._member, path = self._entries.pop(0)
+        self._current = open(path, 'rb')
+        self._remaining = self._member.length
+        self._crc = 0
+        return True
+
+    def _finish_member(self):
+        changed = self._current.read(1) or self._crc != self._member.crc32
+        self._current.close()
+        self._current = None
+        if changed:
+            raise PayloadError(f"'{self._member.name}' changed while it was being archived.")
+
+    def read(self, size):
+        out = self._head[:size]
+        self._head = self._head[size:]
+        while len(out) < size:
+            if self._current is None and not self._next_member():
+                break
+            if self._remaining > 0:
+                data = self._current.read(min(size - len(out), self._remaining))
+                if not data:
+                    raise PayloadError(f"'{self._member.name}' changed while it was being archived.")
+                self._crc = zlib.crc32(data, self._crc)
+                self._remaining -= len(data)
+                out += data
+            if self._remaining == 0:
+                self._finish_member()
+        return out
+
+    def close(self):
+        if self._current is not None:
+            self._current.close()
+            self._current = None
+
+
+def read_index(payload):
+    # Reads the archive index through a PayloadReader. Returns a list of ArchiveMember.
+    size = payload.read_size()
+    head = payload.read(ARCHIVE_HEADER_LEN)
+    if len(head) < ARCHIVE_HEADER_LEN or size < ARCHIVE_HEADER_LEN:
+        raise PayloadError("Carrier does not hold an Opaline archive (or the key is wrong).")
+    magic, index_len = struct.unpack(ARCHIVE_HEADER_FORMAT, head)
+    if magic != ARCHIVE_MAGIC or ARCHIVE_HEADER_LEN + index_len > size:
+        raise PayloadError("Carrier does not hold an Opaline archive (or the key is wrong).")
+
+    index = payload.read(index_len)
+    members = []
+    pos = 0
+    while pos < len(index):
+        if pos + ENTRY_LEN > len(index):
+            raise PayloadError("Archive index is corrupted.")
+        offset, length, crc, name_len = struct.unpack_from(ENTRY_FORMAT, index, pos)
+        pos += ENTRY_LEN
+        name = index[pos:pos + name_len].decode('utf-8', errors='replace')
+        pos += name_len
+        if offset + length > size:
+            raise PayloadError(f"Archive entry '{name}' points past the end of the archive.")
+        members.append(ArchiveMember(name, offset, length, crc))
+    return members
+
+
+def member_path(out_dir, name):
+    # Resolves where a member is extracted, refusing names that would escape `out_dir`.
+    parts = name.split('/')
+    if not name or name.startswith('/') or '\\' in name or ':' in parts[0] or any(p in ('', '.', '..') for p in parts):
+        raise PayloadError(f"Refusing to extract unsafe archive name '{name}'.")
+    return os.path.join(out_dir, *parts)
+
+
+def extract_member(payload, member, dst, progress=None):
+    # Seeks to one member's data and copies it to the binary file object `dst`, checking its CRC-32.
+    payload.seek(SIZE_BYTES_LEN + member.offset)
+    remaining = member.length
+    crc = 0
+    while remaining > 0:
+        data = payload.read(min(COPY_CHUNK_SIZE, remaining))
+        if not data:
+            raise PayloadError(f"Archive ends inside '{member.name}'.")
+        crc = zlib.crc32(data, crc)
+        dst.write(data)
+        remaining -= len(data)
+        if progress:
+            progress(member.length - remaining, member.length)
+    if crc != member.crc32:
+        raise PayloadError(f"Checksum mismatch for '{member.name}'. The carrier may be corrupted.")
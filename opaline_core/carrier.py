@@ -0,0 +1,163 @@
+# Common interface for container backends. A writer is told up front how many carrier bytes it will
+# receive, accepts them in order through write() and finishes the media file in close(). A reader
+# returns the carrier bytes back in order through read(), including any trailing padding.
+#
+# write() is split into pack() (CPU work such as laying bytes out into frames or scanlines) and
+# write_packed() (compression and I/O) so the pipelined encoder can run the two in separate threads.
+# Both are called in order, one chunk at a time. checkpoint() is only called between write_packed() calls.
+
+import os
+import importlib
+
+SKIP_CHUNK_SIZE = 1 << 20  # Bytes read per step when a reader seeks forward by discarding
+
+def sync_file(f):
+    # Pushes everything written to `f` onto the disk, so a checkpoint never points past saved data.
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def reopen_truncated(path, length):
+    # Reopens an interrupted output for appending at `length`, cutting off anything written after its
+    # checkpoint. A file shorter than that was replaced or damaged since, so it cannot be resumed.
+    f = open(path, 'r+b')
+    if os.fstat(f.fileno()).st_size < length:
+        f.close()
+        raise CarrierError(f"'{path}' is shorter than its checkpoint; cannot resume.")
+    f.truncate(length)
+    f.seek(0, 2)
+    return f
+
+
+class CarrierError(Exception):
+    # Raised when a media file cannot be written or read as a carrier.
+    pass
+
+
+class CarrierWriter:
+    def __init__(self, path, payload_len):
+        self.path = path
+        self.payload_len = payload_len
+
+    def pack(self, data):
+        return data
+
+    def write_packed(self, packed):
+        raise NotImplementedError
+
+    def write(self, data):
+        self.write_packed(self.pack(data))
+
+    def close(self):
+        raise NotImplementedError
+
+    def abort(self):
+        # Called instead of close() when encoding fails part way. Backends release resources here.
+        pass
+
+    def checkpoint(self):
+        # Writers that can continue an interrupted encode flush what they have written to disk and return
+        # (carrier_offset, state); a new writer opened with resume=state carries on from carrier_offset.
+        # Others return None.
+        return None
+
+    def suspend(self):
+        # Called instead of abort() when a checkpointed encode is interrupted: releases resources but
+        # keeps the partial output for a later resume.
+        self.abort()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+
+class CarrierReader:
+    # Backends implement _read(). Readers that can jump to an offset also implement _seek(); every
+    # reader can still seek forward by reading and discarding.
+    def __init__(self, path):
+        self.path = path
+        self.position = 0
+
+    def read(self, size=-1):
+        data = self._read(size)
+        self.position += len(data)
+        return data
+
+    def seek(self, offset):
+        # Moves to carrier byte `offset`.
+        if self._seek(offset):
+            self.position = offset
+            return
+        if offset < self.position:
+            raise CarrierError(f"Cannot seek backwards in '{self.path}'.")
+        while self.position < offset:
+            if not self.read(min(SKIP_CHUNK_SIZE, offset - self.position)):
+                break
+
+    def _read(self, size):
+        raise NotImplementedError
+
+    def _seek(self, offset):
+        # Returns True after jumping to `offset`, or False if the caller should read forward instead.
+        return False
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+class BufferedReader(CarrierReader):
+    # Reader over carrier bytes already held in memory.
+    def __init__(self, path, data):
+        super().__init__(path)
+        self._data = memoryview(data)
+        self._pos = 0
+
+    def _read(self, size):
+        end = len(self._data) if size is None or size < 0 else self._pos + size
+        chunk = bytes(self._data[self._pos:end])
+        self._pos += len(chunk)
+        return chunk
+
+    def _seek(self, offset):
+        self._pos = offset
+        return True
+
+
+# --- Backend registry ---
+BACKENDS = {}
+# Built-in backends register themselves when their module is first imported, which happens on first use
+_BUILTIN_BACKENDS = {'png': 'png', 'wav': 'wav', 'mp4': 'mp4'}
+
+
+def register_backend(media_type, writer_cls, reader_cls):
+    BACKENDS[media_type] = (writer_cls, reader_cls)
+
+
+def _backend(media_type):
+    if media_type not in BACKENDS and media_type in _BUILTIN_BACKENDS:
+        importlib.import_module(f".{_BUILTIN_BACKENDS[media_type]}", __package__)
+    try:
+        return BACKENDS[media_type]
+    except KeyError:
+        raise CarrierError(f"Unknown media type '{media_type}'.") from None
+
+
+def open_writer(media_type, path, payload_len, **params):
+    return _backend(media_type)[0](path, payload_len, **params)
+
+
+def open_reader(media_type, path, **params):
+    return _backend(media_type)[1](path, **params)
@@ -0,0 +1,164 @@
+import os
+import time
+
+from .carrier import CarrierError, open_writer, open_reader
+from .payload import MODE_ADDITIVE, CHUNK_SIZE, PayloadError, PayloadReader, carrier_length, encode_stream, decode_stream
+from .resume import encode_resumable
+from .archive import ArchiveSource, scan_directory, archive_size, read_index, member_path, extract_member
+
+# Engine runs encode and decode jobs with settings of its own. Everything a job changes while it runs
+# lives on its Job object, and the engine itself is never modified after construction, so one engine
+# can run many jobs at once from different threads (for example on a ThreadPoolExecutor).
+
+
+class Job:
+    # Settings and live progress of one encode or decode. `done` and `total` are carrier or file bytes
+    # and may be read from other threads while the job runs.
+    def __init__(self, kind, media_type, source, output, progress=None):
+        self.kind = kind
+        self.media_type = media_type
+        self.source = source
+        self.output = output
+        self.done = 0
+        self.total = 0
+        self.elapsed = None
+        self.written = None   # Decode jobs: bytes recovered
+        self.expected = None  # Decode jobs: size recorded in the carrier
+        self.resumed_from = 0  # Resumed encodes: carrier offset the job continued from
+        self.members = None   # Archive jobs: the members packed or extracted
+        self._progress = progress
+        self._started = time.perf_counter()
+
+    def report(self, done, total):
+        self.done, self.total = done, total
+        if self._progress:
+            self._progress(done, total)
+
+    def finish(self):
+        self.elapsed = time.perf_counter() - self._started
+
+
+class Engine:
+    # `pipelined` overlaps reading, ciphering, packing and writing in separate threads. `png_workers` and
+    # `mp4_workers` set how many threads (PNG) or ffmpeg processes (MP4) each job compresses with.
+    # With `resumable`, encodes are checkpointed next to their output (see resume.py).
+    def __init__(self, pipelined=True, chunk_size=CHUNK_SIZE, png_workers=1, mp4_workers=1, resumable=False):
+        self.pipelined = pipelined
+        self.chunk_size = chunk_size
+        self.png_workers = max(1, png_workers)
+        self.mp4_workers = max(1, mp4_workers)
+        self.resumable = resumable
+
+    def encode(self, src_path, media_type, output_path, key_str, mode=MODE_ADDITIVE, params=None, record=None,
+               digest=None, progress=None):
+        # Encodes the file at `src_path` into a new carrier. `params` are the backend's writer settings.
+        # A checkpoint `record` (from load_checkpoint) resumes an interrupted encode. Returns the Job.
+        job = Job('encode', media_type, src_path, output_path, progress)
+        params = {**self._writer_params(media_type), **(params or {})}
+        try:
+            if self.resumable or record is not None:
+                job.resumed_from = encode_resumable(
+                    src_path, media_type, output_path, key_str, mode, params, record=record, digest=digest,
+                    chunk_size=self.chunk_size, progress=job.report, pipelined=self.pipelined)
+            else:
+                file_size = os.path.getsize(src_path)
+                with open(src_path, 'rb') as src, \
+                     open_writer(media_type, output_path, carrier_length(file_size), **params) as writer:
+                    encode_stream(src, file_size, writer, key_str, mode, self.chunk_size, job.report, self.pipelined)
+        finally:
+            job.finish()
+        return job
+
+    def decode(self, carrier_path, media_type, output_path, key_str, progress=None):
+        # Recovers the file held in a carrier. A wrong key raises PayloadError (ValueError for a malformed
+        # key) and a damaged carrier PayloadError or CarrierError; either way the partial output is removed.
+        # Returns the Job.
+        job = Job('decode', media_type, carrier_path, output_path, progress)
+        try:
+            with open_reader(media_type, carrier_path, **self._reader_params(media_type)) as reader:
+                try:
+                    with open(output_path, 'wb') as dst:
+                        job.written, job.expected = decode_stream(reader, dst, key_str, self.chunk_size, job.report,
+                                                                  self.pipelined)
+                except (PayloadError, CarrierError, ValueError):
+                    _remove_partial(output_path)
+                    raise
+        finally:
+            job.finish()
+        return job
+
+    def encode_directory(self, directory, media_type, output_path, key_str, mode=MODE_ADDITIVE, params=None,
+                         progress=None, entries=None):
+        # Packs every file under `directory` into one archive carrier. `entries` from scan_directory()
+        # can be passed to skip scanning again. Returns the Job, with the archive members.
+        job = Job('encode', media_type, directory, output_path, progress)
+        params = {**self._writer_params(media_type), **(params or {})}
+        try:
+            if entries is None:
+                entries = scan_directory(directory)
+            job.members = [member for member, _ in entries]
+            size = archive_size(entries)
+            source = ArchiveSource(entries)
+            try:
+                with open_writer(media_type, output_path, carrier_length(size), **params) as writer:
+                    encode_stream(source, size, writer, key_str, mode, self.chunk_size, job.report, self.pipelined)
+            finally:
+                source.close()
+        finally:
+            job.finish()
+        return job
+
+    def list_archive(self, carrier_path, media_type, key_str):
+        # Returns the members of an archive carrier. Only the index is read.
+        with open_reader(media_type, carrier_path, **self._reader_params(media_type)) as reader:
+            return read_index(PayloadReader(reader, key_str))
+
+    def extract(self, carrier_path, media_type, key_str, out_dir, member_names=None, progress=None):
+        # Extracts the named members (all when None) of an archive carrier into `out_dir`, reading only
+        # the index and those members. Returns the Job, with the extracted members.
+        job = Job('decode', media_type, carrier_path, out_dir, progress)
+        try:
+            with open_reader(media_type, carrier_path, **self._reader_params(media_type)) as reader:
+                payload = PayloadReader(reader, key_str)
+                members = read_index(payload)
+                if member_names is not None:
+                    wanted = set(member_names)
+                    missing = wanted - {m.name for m in members}
+                    if missing:
+                        raise PayloadError(f"Not in the archive: {', '.join(sorted(missing))}")
+                    members = [m for m in members if m.name in wanted]
+                job.members = members
+                total = sum(m.length for m in members)
+                before = 0
+                for member in members:
+                    path = member_path(out_dir, member.name)
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    try:
+                        with open(path, 'wb') as dst:
+                            extract_member(payload, member, dst,
+                                           progress=lambda done, _: job.report(before + done, total))
+                    except (PayloadError, CarrierError):
+                        _remove_partial(path)
+                        raise
+                    before += member.length
+                job.written = job.expected = total
+        finally:
+            job.finish()
+        return job
+
+    def _writer_params(self, media_type):
+        if media_type == 'png':
+            return {'workers': self.png_workers}
+        if media_type == 'mp4':
+            return {'workers': self.mp4_workers}
+        return {}
+
+    def _reader_params(self, media_type):
+        return {'workers': self.mp4_workers} if media_type == 'mp4' else {}
+
+
+def _remove_partial(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
@@ -0,0 +1,474 @@
+import os
+import json
+import math
+import shutil
+import tempfile
+import functools
+import subprocess
+from collections import deque
+
+from .carrier import CarrierError, CarrierWriter, CarrierReader, register_backend, sync_file, reopen_truncated
+
+# --- Audio Configuration ---
+AUDIO_SAMPLE_RATE = 44100
+AUDIO_CHANNELS = 2
+AUDIO_SAMPLE_FORMAT = "s16le"
+AUDIO_BYTES_PER_SAMPLE = 2
+AUDIO_FRAME_SIZE = AUDIO_BYTES_PER_SAMPLE * AUDIO_CHANNELS  # e.g., 4 bytes per frame
+AUDIO_CODEC = "flac"
+
+# Kaleidoscope layout: carrier bytes fill every video frame (raw RGB24, lossless x264) first, then
+# the audio track (raw s16le, FLAC). Only the tail of the audio holds zero padding. The video is made of
+# segments of whole frames encoded separately and joined losslessly; the MP4's comment tag records the
+# segment length so the segments can be found again for decoding.
+BYTES_PER_PIXEL = 3
+PIPE_CHUNK_SIZE = 1 << 20
+WORK_DIR_SUFFIX = ".parts"
+SEGMENT_BYTES = 1 << 26  # Raw video per segment, rounded down to whole frames
+SEGMENT_TAG = "kaleidoscope-segments"
+FFMPEG_PROBE_CACHE = os.path.join(os.path.expanduser("~"), ".cache", "kaleidoscope", "ffmpeg_probe.json")
+
+
+def run_ffmpeg_process(cmd, stdin_data=None):
+    stdin_pipe = subprocess.PIPE if stdin_data is not None else None
+    process = subprocess.Popen(cmd, stdin=stdin_pipe, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout_data, stderr_data = process.communicate(input=stdin_data)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, cmd, output=stdout_data, stderr=stderr_data)
+    return stdout_data
+
+
+@functools.lru_cache(maxsize=None)
+def ffmpeg_available():
+    # Checks that ffmpeg and ffprobe run. A successful probe is cached on disk, keyed by each
+    # binary's path, size and mtime, so later runs skip the version subprocesses until they change.
+    tools = ("ffmpeg", "ffprobe")
+    fingerprint = {}
+    for tool in tools:
+        path = shutil.which(tool)
+        if path is None:
+            return False
+        st = os.stat(path)
+        fingerprint[tool] = [path, st.st_size, st.st_mtime_ns]
+
+    try:
+        with open(FFMPEG_PROBE_CACHE, 'r') as f:
+            if json.load(f) == fingerprint:
+                return True
+    except (OSError, ValueError):
+        pass
+
+    try:
+        for tool in tools:
+            subprocess.run([fingerprint[tool][0], "-version"], check=True,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return False
+
+    try:
+        os.makedirs(os.path.dirname(FFMPEG_PROBE_CACHE), exist_ok=True)
+        with open(FFMPEG_PROBE_CACHE, 'w') as f:
+            json.dump(fingerprint, f)
+    except OSError:
+        pass  # The cache is only an optimisation
+    return True
+
+
+def audio_capacity(frames, fps):
+    # Bytes of PCM audio that last as long as `frames` video frames.
+    return math.ceil(frames * AUDIO_SAMPLE_RATE / fps) * AUDIO_FRAME_SIZE
+
+
+def mp4_layout(payload_len, width, height, fps=1):
+    # Returns (frames, video_capacity, audio_capacity) for the fewest frames that hold payload_len bytes.
+    bytes_per_frame = width * height * BYTES_PER_PIXEL
+    if bytes_per_frame <= 0 or fps <= 0:
+        raise CarrierError("Invalid dimensions.")
+    per_frame = bytes_per_frame + AUDIO_SAMPLE_RATE * AUDIO_FRAME_SIZE / fps
+    frames = max(1, math.ceil(payload_len / per_frame) - 1)
+    while frames * bytes_per_frame + audio_capacity(frames, fps) < payload_len:
+        frames += 1
+    return frames, frames * bytes_per_frame, audio_capacity(frames, fps)
+
+
+def _write_zeros(f, count):
+    block = bytes(min(count, PIPE_CHUNK_SIZE))
+    while count > 0:
+        count -= f.write(block[:count])
+
+
+def segment_frames_for(width, height):
+    # Frames per independently encoded segment: about SEGMENT_BYTES of raw video, at least one frame.
+    return max(1, SEGMENT_BYTES // (width * height * BYTES_PER_PIXEL))
+
+
+def segment_tag(segment_frames, frames, fps):
+    return f"{SEGMENT_TAG} segment_frames={segment_frames} frames={frames} fps={fps}"
+
+
+def parse_segment_tag(comment):
+    # Returns (segment_frames, frames, fps) from a comment written by segment_tag(), or None.
+    fields = (comment or '').split()
+    if not fields or fields[0] != SEGMENT_TAG:
+        return None
+    try:
+        values = dict(field.split('=', 1) for field in fields[1:])
+        return int(values['segment_frames']), int(values['frames']), int(values['fps'])
+    except (KeyError, ValueError):
+        return None
+
+
+def _ffmpeg_threads(workers):
+    # Threads for each of `workers` concurrent ffmpeg processes, sharing the machine's cores between them.
+    return str(max(1, (os.cpu_count() or 1) // workers))
+
+
+def _remove_spool(spool_path):
+    try:
+        os.remove(spool_path)
+    except FileNotFoundError:
+        pass
+
+
+def _remove_finished_spool(future):
+    # Done callback for a dropped segment decode: deletes the spool it produced, if it produced one.
+    if not future.cancelled() and future.exception() is None:
+        _remove_spool(future.result())
+
+
+class Mp4Writer(CarrierWriter):
+    # Video bytes are cut into time segments of segment_frames frames. Each segment is spooled to a raw
+    # file in a work directory beside the output (<output>.parts) and, once full, encoded on its own by
+    # one of `workers` ffmpeg processes while later segments are still arriving. Audio is spooled whole.
+    # close() joins the segments with the concat demuxer (stream copy), muxes in the audio and records the
+    # segment length in the comment tag so readers can decode the segments in parallel too.
+    #
+    # The work directory is removed once the MP4 is written, or kept by suspend() so an interrupted
+    # encode can be resumed: encoded segments are kept and only the rest is redone.
+    # segment_frames defaults to segment_frames_for(width, height).
+    def __init__(self, path, payload_len, width, height, fps=1, workers=1, segment_frames=None, resume=None):
+        super().__init__(path, payload_len)
+        self.width, self.height, self.fps = width, height, fps
+        self.frames, self.video_capacity, self.audio_capacity = mp4_layout(payload_len, width, height, fps)
+        self.bytes_per_frame = width * height * BYTES_PER_PIXEL
+        self.segment_frames = max(1, segment_frames or segment_frames_for(width, height))
+        self.segments = -(-self.frames // self.segment_frames)
+        self.workers = max(1, workers)
+        self._segment_bytes = self.segment_frames * self.bytes_per_frame
+        self._segment = None  # Spool of the segment being filled
+        self._encoding = deque()  # Futures of submitted segment encodes, oldest first
+        self._work_dir = path + WORK_DIR_SUFFIX
+        self._audio_path = os.path.join(self._work_dir, "audio.pcm")
+        self._checkpointed = resume is not None
+        try:
+            if resume is not None:
+                if resume.get('segment_frames') != self.segment_frames:
+                    raise CarrierError("The checkpoint was made with a different segment layout; cannot resume.")
+                self._video_written = resume['video']
+                self._audio = reopen_truncated(self._audio_path, resume['audio'])
+            else:
+                shutil.rmtree(self._work_dir, ignore_errors=True)
+                os.makedirs(self._work_dir)
+                self._video_written = 0
+                self._audio = open(self._audio_path, 'wb')
+        except OSError as e:
+            raise CarrierError(f"Cannot prepare work directory '{self._work_dir}': {e}") from None
+
+        from concurrent.futures import ThreadPoolExecutor  # Deferred: it pulls in logging
+        self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        if resume is not None:
+            self._resume_segments()
+
+    def _segment_path(self, index, ext):
+        return os.path.join(self._work_dir, f"segment{index:06d}{ext}")
+
+    def _resume_segments(self):
+        # Segments with a finished .mp4 are done. Full segments without one are encoded again from their
+        # spool, and the segment being filled is cut back to the checkpoint.
+        full, partial = divmod(self._video_written, self._segment_bytes)
+        try:
+            for index in range(full):
+                if not os.path.exists(self._segment_path(index, '.mp4')):
+                    if not os.path.exists(self._segment_path(index, '.rgb')):
+                        raise CarrierError(f"Segment {index} is missing from '{self._work_dir}'; cannot resume.")
+                    self._submit(index)
+            if partial:
+                self._segment = reopen_truncated(self._segment_path(full, '.rgb'), partial)
+        except OSError as e:
+            raise CarrierError(f"Cannot resume from '{self._work_dir}': {e}") from None
+
+    def write_packed(self, data):
+        while data and self._video_written < self.video_capacity:
+            index, used = divmod(self._video_written, self._segment_bytes)
+            room = min(self._segment_bytes - used, self.video_capacity - self._video_written)
+            if self._segment is None:
+                self._segment = open(self._segment_path(index, '.rgb'), 'wb')
+            chunk = data[:room]
+            self._segment.write(chunk)
+            self._video_written += len(chunk)
+            data = data[len(chunk):]
+            if len(chunk) == room:
+                sync_file(self._segment)
+                self._segment.close()
+                self._segment = None
+                self._submit(index)
+        if data:
+            self._audio.write(data)
+
+    def _submit(self, index):
+        self._encoding.append(self._executor.submit(self._encode_segment, index))
+        # Keep a bounded number of segments in flight, so spooled video cannot pile up on disk
+        while len(self._encoding) > 2 * self.workers:
+            self._encoding.popleft().result()
+
+    def _encode_segment(self, index):
+        # Runs in a worker thread. The .mp4 only appears once complete, and then the spool is removed.
+        frames = min(self.segment_frames, self.frames - index * self.segment_frames)
+        part_path = self._segment_path(index, '.mp4.part')
+        cmd = [
+            "ffmpeg", "-y", "-v", "error",
+            "-f", "rawvideo", "-pix_fmt", "rgb24",
+            "-s", f"{self.width}x{self.height}",
+            "-framerate", str(self.fps),
+            "-i", self._segment_path(index, '.rgb'),
+            "-frames:v", str(frames),
+            "-c:v", "libx264rgb", "-preset", "ultrafast", "-crf", "0", "-pix_fmt", "rgb24",
+            "-threads", _ffmpeg_threads(self.workers),
+            "-f", "mp4", part_path
+        ]
+        try:
+            run_ffmpeg_process(cmd)
+        except subprocess.CalledProcessError as e:
+            raise CarrierError(f"ffmpeg failed on segment {index}: {e.stderr.decode(errors='replace').strip()}") from None
+        os.replace(part_path, self._segment_path(index, '.mp4'))
+        os.remove(self._segment_path(index, '.rgb'))
+
+    def checkpoint(self):
+        # Full segments are synced when they are closed; only the one being filled needs it here.
+        self._checkpointed = True
+        if self._segment is not None:
+            sync_file(self._segment)
+        sync_file(self._audio)
+        audio_written = self._audio.tell()
+        state = {'video': self._video_written, 'audio': audio_written,
+                 'frames': self._video_written // self.bytes_per_frame, 'segment_frames': self.segment_frames}
+        return self._video_written + audio_written, state
+
+    def _mux_command(self, list_path):
+        return [
+            "ffmpeg", "-y", "-v", "error",
+            "-f", "concat", "-safe", "0", "-i", list_path,
+            "-f", AUDIO_SAMPLE_FORMAT,
+            "-ar", str(AUDIO_SAMPLE_RATE),
+            "-ac", str(AUDIO_CHANNELS),
+            "-i", self._audio_path,
+            "-map", "0:v", "-map", "1:a",
+            "-c:v", "copy", "-c:a", AUDIO_CODEC,
+            "-metadata", f"comment={segment_tag(self.segment_frames, self.frames, self.fps)}",
+            "-shortest",
+            self.path
+        ]
+
+    def close(self):
+        try:
+            padding = self.video_capacity - self._video_written
+            while padding > 0:
+                n = min(PIPE_CHUNK_SIZE, padding)
+                self.write_packed(bytes(n))
+                padding -= n
+            _write_zeros(self._audio, self.audio_capacity - self._audio.tell())
+            self._audio.close()
+            while self._encoding:
+                self._encoding.popleft().result()
+            list_path = os.path.join(self._work_dir, "segments.txt")
+            with open(list_path, 'w') as f:
+                for index in range(self.segments):
+                    f.write(f"file '{os.path.basename(self._segment_path(index, '.mp4'))}'\n")
+            run_ffmpeg_process(self._mux_command(list_path))
+        except subprocess.CalledProcessError as e:
+            self.abort()
+            raise CarrierError(f"ffmpeg failed: {e.stderr.decode(errors='replace').strip()}") from None
+        except CarrierError:
+            self.abort()
+            raise
+        except BaseException:
+            # An interrupted checkpointed encode keeps its segments for the resume
+            if self._checkpointed:
+                self.suspend()
+            else:
+                self.abort()
+            raise
+        self.abort()
+
+    def abort(self):
+        self.suspend()
+        shutil.rmtree(self._work_dir, ignore_errors=True)
+
+    def suspend(self):
+        self._executor.shutdown(cancel_futures=True)
+        if self._segment is not None:
+            self._segment.close()
+            self._segment = None
+        self._audio.close()
+
+
+class Mp4Reader(CarrierReader):
+    # Streams the decoded video and then the decoded audio. Segmented carriers (with a segment comment
+    # tag) have their video segments decoded in parallel, each by its own ffmpeg process into a raw
+    # spool, at most `workers` + 1 segments ahead of the reader; they can also seek to any segment.
+    # Older carriers are decoded through one ffmpeg pipe. Audio always comes from one pipe.
+    def __init__(self, path, workers=1):
+        super().__init__(path)
+        if not os.path.exists(path):
+            raise CarrierError(f"File not found: {path}")
+        self.workers = max(1, workers)
+        audio_command = ["ffmpeg", "-v", "error", "-i", path, "-map", "0:a:0", "-f", AUDIO_SAMPLE_FORMAT,
+                         "-ar", str(AUDIO_SAMPLE_RATE), "-ac", str(AUDIO_CHANNELS), "-acodec", "pcm_s16le", "-"]
+        self._proc = None
+        self._segments = None
+        self._current = None
+
+        width, height, comment = self._probe()
+        layout = parse_segment_tag(comment)
+        if layout is None:
+            self._commands = [
+                ["ffmpeg", "-v", "error", "-i", path, "-map", "0:v:0", "-f", "rawvideo", "-pix_fmt", "rgb24", "-"],
+                audio_command,
+            ]
+            return
+
+        self._commands = [audio_command]
+        segment_frames, frames, self.fps = layout
+        self.bytes_per_frame = width * height * BYTES_PER_PIXEL
+        self._segment_bytes = segment_frames * self.bytes_per_frame
+        self.video_capacity = frames * self.bytes_per_frame
+        self._segments = [(start, min(segment_frames, frames - start)) for start in range(0, frames, segment_frames)]
+        self._next_segment = 0
+        self._decoding = deque()
+        from concurrent.futures import ThreadPoolExecutor  # Deferred: it pulls in logging
+        self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        self._tmpdir = tempfile.TemporaryDirectory(prefix="kaleidoscope_")
+
+    def _probe(self):
+        # Returns (width, height, comment tag) of the video.
+        cmd = ["ffprobe", "-v", "error", "-select_streams", "v:0",
+               "-show_entries", "stream=width,height:format_tags=comment", "-of", "json", self.path]
+        try:
+            info = json.loads(run_ffmpeg_process(cmd))
+            stream = info['streams'][0]
+            return stream['width'], stream['height'], info.get('format', {}).get('tags', {}).get('comment')
+        except (subprocess.CalledProcessError, ValueError, KeyError, IndexError):
+            raise CarrierError(f"Cannot read video information from '{self.path}'.") from None
+
+    def _decode_segment(self, index):
+        # Runs in a worker thread. Seeks to half a frame before the segment's first frame, so rounding in
+        # the timestamps can neither drop that frame nor let the previous one in, then takes its frames.
+        # Each run gets its own spool file, so a segment dropped by a seek and decoded again never shares one.
+        start, frames = self._segments[index]
+        fd, out_path = tempfile.mkstemp(prefix=f"segment{index:06d}_", suffix=".rgb", dir=self._tmpdir.name)
+        os.close(fd)
+        # -threads ahead of -i sizes the decoder's thread pool; after it, it would only apply to the output
+        cmd = ["ffmpeg", "-y", "-v", "error", "-threads", _ffmpeg_threads(self.workers)]
+        if start:
+            cmd += ["-ss", f"{(start - 0.5) / self.fps:.6f}"]
+        # Passthrough keeps each decoded frame once. The default constant-rate sync would duplicate the
+        # first frame to fill the half-frame gap left by the seek. (-vsync, unlike -fps_mode, predates ffmpeg 5.1.)
+        cmd += ["-i", self.path, "-map", "0:v:0", "-frames:v", str(frames), "-vsync", "passthrough",
+                "-f", "rawvideo", "-pix_fmt", "rgb24", out_path]
+        try:
+            run_ffmpeg_process(cmd)
+        except subprocess.CalledProcessError as e:
+            _remove_spool(out_path)
+            raise CarrierError(f"ffmpeg failed on segment {index}: {e.stderr.decode(errors='replace').strip()}") from None
+        if os.path.getsize(out_path) != frames * self.bytes_per_frame:
+            _remove_spool(out_path)
+            raise CarrierError(f"Segment {index} of '{self.path}' decoded to the wrong number of frames.")
+        return out_path
+
+    def _read_segments(self, size):
+        # Returns up to `size` bytes of decoded video, or b'' once every segment has been read.
+        while True:
+            if self._current is not None:
+                chunk = self._current.read(size)
+                if chunk:
+                    return chunk
+                self._current.close()
+                _remove_spool(self._current.name)
+                self._current = None
+            while self._next_segment < len(self._segments) and len(self._decoding) <= self.workers:
+                self._decoding.append(self._executor.submit(self._decode_segment, self._next_segment))
+                self._next_segment += 1
+            if not self._decoding:
+                return b''
+            self._current = open(self._decoding.popleft().result(), 'rb')
+
+    def _next_process(self):
+        if self._proc is not None:
+            self._proc.stdout.close()
+            if self._proc.wait() != 0:
+                raise CarrierError(f"ffmpeg failed while decoding '{self.path}'.")
+            self._proc = None
+        if self._commands:
+            self._proc = subprocess.Popen(self._commands.pop(0), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        return self._proc is not None
+
+    def _read(self, size):
+        parts = []
+        wanted = size if size is not None and size >= 0 else None
+        while wanted is None or wanted > 0:
+            chunk = b''
+            if self._segments is not None:
+                chunk = self._read_segments(PIPE_CHUNK_SIZE if wanted is None else wanted)
+            if not chunk:
+                if self._proc is None and not self._next_process():
+                    break
+                chunk = self._proc.stdout.read(PIPE_CHUNK_SIZE if wanted is None else wanted)
+                if not chunk:
+                    self._next_process()
+                    continue
+            parts.append(chunk)
+            if wanted is not None:
+                wanted -= len(chunk)
+        return b''.join(parts)
+
+    def _seek(self, offset):
+        # Jumps to any offset in the video of a segmented carrier, as long as the audio has not started.
+        if self._segments is None or offset >= self.video_capacity or self._proc is not None:
+            return False
+        index, skip = divmod(offset, self._segment_bytes)
+        self._drop_segments()
+        self._next_segment = index
+        while skip > 0:
+            chunk = self._read_segments(min(skip, PIPE_CHUNK_SIZE))
+            if not chunk:
+                break
+            skip -= len(chunk)
+        return True
+
+    def _drop_segments(self):
+        # Discards the segment being read and those queued or decoding, deleting their spools. Decodes
+        # that are already running delete theirs when they finish.
+        if self._current is not None:
+            self._current.close()
+            _remove_spool(self._current.name)
+            self._current = None
+        for future in self._decoding:
+            if not future.cancel():
+                future.add_done_callback(_remove_finished_spool)
+        self._decoding.clear()
+
+    def close(self):
+        if self._proc is not None:
+            self._proc.kill()
+            self._proc.stdout.close()
+            self._proc.wait()
+            self._proc = None
+        self._commands = []
+        if self._segments is not None:
+            self._drop_segments()
+            self._executor.shutdown(cancel_futures=True)
+            self._tmpdir.cleanup()
+            self._segments = None
+
+
+register_backend('mp4', Mp4Writer, Mp4Reader)
@@ -0,0 +1,325 @@
+import os
+import struct
+import hashlib
+
+from .pipeline import run_pipeline
+
+# --- Format ---
+# A carrier holds: mode header (unciphered) + ciphered(size header + file data) + zero padding.
+SIZE_STRUCT_FORMAT = '>Q'
+SIZE_BYTES_LEN = struct.calcsize(SIZE_STRUCT_FORMAT)
+
+# Mode header: magic + cipher mode byte + salt + key verifier. Data written before the header existed
+# has no magic and is treated as MODE_ADDITIVE with a zero-length header (and so cannot check the key).
+HEADER_MAGIC = b'OPAL'
+MODE_ADDITIVE = 0   # Repeating hex byte key added mod 256 (the original cipher)
+MODE_KEYSTREAM = 1  # Passphrase expanded into a SHAKE-128 counter-mode keystream, XORed in bulk
+SALT_LEN = 16
+VERIFIER_LEN = 8
+VERIFIER_LABEL = b'opaline key verifier'
+VERIFIER_SPAN = 64  # Bytes of repeated hex key the additive verifier is computed over
+HEADER_LEN = len(HEADER_MAGIC) + 1 + SALT_LEN + VERIFIER_LEN
+
+KDF_ITERATIONS = 200_000
+KEYSTREAM_BLOCK_SIZE = 1 << 16  # Bytes of keystream per SHAKE call; block N covers offsets [N*size, (N+1)*size)
+CHUNK_SIZE = 1 << 22            # Bytes moved through the pipeline per step
+
+
+
+class PayloadError(Exception):
+    # Raised when carrier data cannot be turned back into a file (bad key, corruption, not an Opaline carrier).
+    pass
+
+
+# --- Keys ---
+def parse_hex_key(key_str):
+    # Parses space-separated hex values into a list of ints. Raises ValueError on a non-hex token.
+    # Values above FF are accepted and act modulo 256, as they always have in the additive cipher.
+    if not key_str:
+        return []
+    return [int(part, 16) for part in key_str.split()]
+
+
+def derive_stream_key(passphrase, salt):
+    # Stretches a passphrase into the 32-byte key that seeds the keystream.
+    return hashlib.pbkdf2_hmac('sha256', passphrase.encode('utf-8'), salt, KDF_ITERATIONS, dklen=32)
+
+
+# --- Ciphers ---
+def _add_table(k):
+    # Translation table adding k mod 256 to every byte, used to cipher a whole key lane in one call.
+    return bytes(range(k, 256)) + bytes(range(k))
+
+
+def additive_cipher(data_bytes, keys, offset=0, encrypting=True):
+    # Adds (or subtracts) keys[(offset + i) % len(keys)] to byte i, mod 256.
+    # Each key position is a strided lane of the data, ciphered with one bytes.translate call.
+    if not keys or not data_bytes:
+        return bytes(data_bytes)
+    key_len = len(keys)
+    out = bytearray(data_bytes)
+    for lane in range(min(key_len, len(out))):
+        k = keys[(offset + lane) % key_len] % 256
+        if not encrypting:
+            k = -k % 256
+        if k:
+            out[lane::key_len] = out[lane::key_len].translate(_add_table(k))
+    return bytes(out)
+
+
+def _keystream_block(stream_key, block, length=KEYSTREAM_BLOCK_SIZE):
+    # The first `length` bytes of keystream block `block`. SHAKE output is a prefix of any longer output.
+    return hashlib.shake_128(stream_key + block.to_bytes(8, 'little')).digest(length)
+
+
+def keystream(stream_key, offset, length):
+    # Returns `length` keystream bytes starting at absolute byte `offset`.
+    # Each block is independent, so any offset can be reached without generating what precedes it.
+    out = bytearray()
+    end = offset + length
+    while offset < end:
+        block, skip = divmod(offset, KEYSTREAM_BLOCK_SIZE)
+        step = min(KEYSTREAM_BLOCK_SIZE - skip, end - offset)
+        out += _keystream_block(stream_key, block, skip + step)[skip:]
+        offset += step
+    return bytes(out)
+
+
+def keystream_cipher(data_bytes, stream_key, offset=0):
+    # XORs data with the keystream starting at `offset`. Encrypting and decrypting are the same operation.
+    # Works one keystream block at a time, straight into the output buffer: a block-sized XOR stays in
+    # cache and no chunk-sized keystream is ever joined or sliced.
+    data_len = len(data_bytes)
+    if data_len == 0:
+        return b''
+    view = memoryview(data_bytes)
+    out = bytearray(data_len)
+    pos = 0
+    while pos < data_len:
+        block, skip = divmod(offset + pos, KEYSTREAM_BLOCK_SIZE)
+        step = min(KEYSTREAM_BLOCK_SIZE - skip, data_len - pos)
+        ks = _keystream_block(stream_key, block, skip + step)
+        out[pos:pos + step] = (int.from_bytes(view[pos:pos + step], 'little')
+                               ^ int.from_bytes(memoryview(ks)[skip:], 'little')).to_bytes(step, 'little')
+        pos += step
+    return out
+
+
+# --- Mode header ---
+def build_header(mode, salt=b'', verifier=b''):
+    return HEADER_MAGIC + bytes([mode]) + salt.ljust(SALT_LEN, b'\x00') + verifier.ljust(VERIFIER_LEN, b'\x00')
+
+
+def parse_header(raw_bytes):
+    # Returns (mode, salt, verifier, header_length). Headerless (pre-header) data reports MODE_ADDITIVE,
+    # no verifier and length 0.
+    if len(raw_bytes) >= HEADER_LEN and raw_bytes[:len(HEADER_MAGIC)] == HEADER_MAGIC:
+        mode = raw_bytes[len(HEADER_MAGIC)]
+        salt_end = len(HEADER_MAGIC) + 1 + SALT_LEN
+        salt = bytes(raw_bytes[len(HEADER_MAGIC) + 1:salt_end])
+        verifier = bytes(raw_bytes[salt_end:HEADER_LEN])
+        return mode, salt, verifier, HEADER_LEN
+    return MODE_ADDITIVE, b'', None, 0
+
+
+def _cipher_key(mode, key_str, salt):
+    # The expanded key a mode ciphers with: the stream key, or the list of hex key values.
+    # Raises ValueError on a bad key.
+    if mode == MODE_KEYSTREAM:
+        if not key_str:
+            raise ValueError("Keystream mode requires a passphrase.")
+        return derive_stream_key(key_str, salt)
+    elif mode == MODE_ADDITIVE:
+        return parse_hex_key(key_str)
+    raise PayloadError(f"Unknown cipher mode {mode}. The file may be corrupted or from a newer version.")
+
+
+def _transform(mode, cipher_key, encrypting):
+    # Returns transform(data, offset) applying the mode's cipher at a body offset.
+    if mode == MODE_KEYSTREAM:
+        return lambda data, offset: keystream_cipher(data, cipher_key, offset)
+    return lambda data, offset: additive_cipher(data, cipher_key, offset, encrypting)
+
+
+def _verifier(mode, cipher_key):
+    # Truncated hash identifying the key. For hex keys it covers the key repeated over VERIFIER_SPAN bytes,
+    # so keys that cipher identically (such as '0A' and '0A 0A') share a verifier.
+    if mode == MODE_KEYSTREAM:
+        material = cipher_key
+    else:
+        material = additive_cipher(bytes(VERIFIER_SPAN), cipher_key)
+    return hashlib.sha256(VERIFIER_LABEL + bytes([mode]) + material).digest()[:VERIFIER_LEN]
+
+
+def open_header(raw_bytes, key_str, encrypting=False):
+    # Returns (transform, header_length) for the mode header at the start of `raw_bytes`.
+    # Raises PayloadError if the key does not match the header's verifier.
+    mode, salt, verifier, header_len = parse_header(raw_bytes)
+    cipher_key = _cipher_key(mode, key_str, salt)
+    if verifier is not None and verifier != _verifier(mode, cipher_key):
+        raise PayloadError("The key or passphrase is wrong.")
+    return _transform(mode, cipher_key, encrypting), header_len
+
+
+def seal_header(mode, key_str):
+    # Returns (header_bytes, transform) for a new carrier, with a fresh salt for keystream mode.
+    salt = os.urandom(SALT_LEN) if mode == MODE_KEYSTREAM else b''
+    cipher_key = _cipher_key(mode, key_str, salt)
+    return build_header(mode, salt, _verifier(mode, cipher_key)), _transform(mode, cipher_key, True)
+
+
+def carrier_length(file_size):
+    # Number of carrier bytes needed for a file of `file_size` bytes, before backend padding.
+    return HEADER_LEN + SIZE_BYTES_LEN + file_size
+
+
+# --- Streaming pipeline ---
+def _read_plain(src, file_size, chunk_size, start=0):
+    # Yields (body_offset, plaintext) chunks: the size header followed by `file_size` bytes of `src`,
+    # beginning at body offset `start` (src is then expected to be positioned at the matching byte).
+    offset = start
+    pending = struct.pack(SIZE_STRUCT_FORMAT, file_size)[start:]
+    remaining = file_size - max(0, start - SIZE_BYTES_LEN)
+    while True:
+        if remaining > 0:
+            data = src.read(min(chunk_size, remaining))
+            if not data:
+                raise PayloadError(f"Input ended {remaining} bytes short of its expected size.")
+            remaining -= len(data)
+            pending += data
+        if not pending:
+            break
+        yield offset, pending
+        offset += len(pending)
+        pending = b''
+
+
+def encode_stream(src, file_size, writer, key_str, mode=MODE_ADDITIVE, chunk_size=CHUNK_SIZE, progress=None,
+                  pipelined=False, header=None, start=0):
+    # Writes the carrier bytes for `src` into a CarrierWriter. `progress(done, total)` is called per chunk.
+    # With pipelined=True, reading, ciphering, packing and writing each run in their own thread.
+    # To continue an interrupted encode, pass its mode `header` and the body offset `start` to carry on
+    # from: the header is not written again and `src` must already be positioned at file byte start - 8.
+    total = carrier_length(file_size)
+    if header is None:
+        header, transform = seal_header(mode, key_str)
+        writer.write(header)
+    else:
+        transform, _ = open_header(header, key_str, encrypting=True)
+    plain = _read_plain(src, file_size, chunk_size, start)
+
+    if not pipelined:
+        for offset, block in plain:
+            writer.write(transform(block, offset))
+            if progress:
+                progress(HEADER_LEN + offset + len(block), total)
+        return
+
+    def cipher_stage(item):
+        offset, block = item
+        return offset + len(block), transform(block, offset)
+
+    def pack_stage(item):
+        end, block = item
+        return end, writer.pack(block)
+
+    def sink(item):
+        end, packed = item
+        writer.write_packed(packed)
+        if progress:
+            progress(HEADER_LEN + end, total)
+
+    run_pipeline(plain, [cipher_stage, pack_stage], sink)
+
+
+def _read_body(reader, first, limit, chunk_size):
+    # Yields (body_offset, raw) chunks from `reader`, starting with `first`, up to `limit` body bytes.
+    offset = 0
+    raw = first[:limit]
+    while raw:
+        yield offset, raw
+        offset += len(raw)
+        if offset >= limit:
+            break
+        raw = reader.read(min(chunk_size, limit - offset))
+
+
+def decode_stream(reader, dst, key_str, chunk_size=CHUNK_SIZE, progress=None, pipelined=False):
+    # Deciphers carrier bytes from a CarrierReader into the binary file object `dst`.
+    # Returns (bytes_written, expected_size); bytes_written is short if the carrier was truncated.
+    # With pipelined=True, reading, deciphering and writing each run in their own thread.
+    head = reader.read(HEADER_LEN)
+    transform, header_len = open_header(head, key_str)
+
+    pending = head[header_len:]
+    while len(pending) < SIZE_BYTES_LEN:
+        more = reader.read(chunk_size)
+        if not more:
+            raise PayloadError(
+                f"Decrypted data stream is too short ({len(pending)} bytes) to contain file size info ({SIZE_BYTES_LEN} bytes).")
+        pending += more
+
+    size_bytes = transform(pending[:SIZE_BYTES_LEN], 0)
+    expected_size = struct.unpack(SIZE_STRUCT_FORMAT, size_bytes)[0]
+    body = _read_body(reader, pending, SIZE_BYTES_LEN + expected_size, chunk_size)
+
+    def cipher_stage(item):
+        offset, raw = item
+        data = transform(raw, offset)
+        return data[SIZE_BYTES_LEN:] if offset == 0 else data
+
+    written = 0
+    def sink(data):
+        nonlocal written
+        dst.write(data)
+        written += len(data)
+        if progress:
+            progress(written, expected_size)
+
+    if pipelined:
+        run_pipeline(body, [cipher_stage], sink)
+    else:
+        for item in body:
+            sink(cipher_stage(item))
+    return written, expected_size
+
+
+class PayloadReader:
+    # Deciphered, seekable view of a carrier's body (size header + file data), for random access.
+    # Offsets are body offsets; seeking moves the underlying CarrierReader past the mode header.
+    def __init__(self, reader, key_str):
+        head = reader.read(HEADER_LEN)
+        self._transform, self.header_len = open_header(head, key_str)
+        self._reader = reader
+        self._pending = head[self.header_len:]
+        self.offset = 0
+
+    def read(self, size):
+        raw = self._pending[:size]
+        self._pending = self._pending[size:]
+        while len(raw) < size:
+            more = self._reader.read(size - len(raw))
+            if not more:
+                break
+            raw += more
+        data = self._transform(raw, self.offset)
+        self.offset += len(raw)
+        return data
+
+    def seek(self, offset):
+        ahead = offset - self.offset
+        if 0 <= ahead <= len(self._pending):
+            self._pending = self._pending[ahead:]
+        else:
+            self._pending = b''
+            self._reader.seek(self.header_len + offset)
+        self.offset = offset
+
+    def read_size(self):
+        # Reads the size header at the start of the body and returns the stored file size.
+        self.seek(0)
+        size_bytes = self.read(SIZE_BYTES_LEN)
+        if len(size_bytes) < SIZE_BYTES_LEN:
+            raise PayloadError(
+                f"Decrypted data stream is too short ({len(size_bytes)} bytes) to contain file size info ({SIZE_BYTES_LEN} bytes).")
+        return struct.unpack(SIZE_STRUCT_FORMAT, size_bytes)[0]
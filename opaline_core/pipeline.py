@@ -0,0 +1,88 @@
+import queue
+import threading
+
+# Bounded producer/consumer pipeline. The source and each stage run in their own thread, connected by
+# queues of at most `depth` items, and the sink runs in the calling thread. zlib, hashlib and file I/O
+# release the GIL, so stages overlap and total time approaches that of the slowest stage.
+
+PIPELINE_DEPTH = 4
+_POLL_INTERVAL = 0.1
+_DONE = object()
+
+
+class _Pipeline:
+    def __init__(self):
+        self.stop = threading.Event()
+        self.error = None
+
+    def fail(self, exc):
+        if self.error is None:
+            self.error = exc
+        self.stop.set()
+
+    def put(self, q, item):
+        # Returns False if the pipeline stopped before the item could be queued.
+        while not self.stop.is_set():
+            try:
+                q.put(item, timeout=_POLL_INTERVAL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(self, q):
+        while True:
+            try:
+                return q.get(timeout=_POLL_INTERVAL)
+            except queue.Empty:
+                if self.stop.is_set():
+                    return _DONE
+
+    def run_source(self, source, out_q):
+        try:
+            for item in source:
+                if not self.put(out_q, item):
+                    return
+            self.put(out_q, _DONE)
+        except BaseException as e:
+            self.fail(e)
+
+    def run_stage(self, fn, in_q, out_q):
+        try:
+            while True:
+                item = self.get(in_q)
+                if item is _DONE:
+                    self.put(out_q, _DONE)
+                    return
+                if not self.put(out_q, fn(item)):
+                    return
+        except BaseException as e:
+            self.fail(e)
+
+
+def run_pipeline(source, stages, sink, depth=PIPELINE_DEPTH):
+    # Feeds every item of `source` through `stages` (callables, in order) into `sink`, one thread per
+    # source/stage. The first exception raised anywhere stops all threads and is re-raised here.
+    pipe = _Pipeline()
+    queues = [queue.Queue(maxsize=depth) for _ in range(len(stages) + 1)]
+    threads = [threading.Thread(target=pipe.run_source, args=(source, queues[0]), daemon=True)]
+    for i, fn in enumerate(stages):
+        threads.append(threading.Thread(target=pipe.run_stage, args=(fn, queues[i], queues[i + 1]), daemon=True))
+    for t in threads:
+        t.start()
+
+    try:
+        while True:
+            item = pipe.get(queues[-1])
+            if item is _DONE or pipe.stop.is_set():
+                break
+            sink(item)
+    except BaseException as e:
+        pipe.fail(e)
+    finally:
+        pipe.stop.set()
+        for t in threads:
+            t.join()
+
+    if pipe.error is not None:
+        raise pipe.error
@@ -0,0 +1,367 @@
+import math
+import zlib
+import struct
+from collections import deque
+
+from .carrier import CarrierError, CarrierWriter, CarrierReader, BufferedReader, register_backend, sync_file, reopen_truncated
+
+# Opaline RGB layout: carrier bytes fill pixels left to right, top to bottom, three bytes per pixel,
+# and the last pixels are zero padding. Carriers are written as 8-bit RGB, non-interlaced PNGs whose
+# scanlines all use filter type 0, streamed through zlib so the whole image is never held in memory.
+#
+# The scanlines are cut into BLOCK_SIZE blocks, each deflated on its own as raw deflate ending in a
+# full flush (the last one finished) and stored as its own IDAT chunk, between an IDAT holding the
+# zlib header and one holding the Adler-32 of all scanlines. Together the IDATs are one ordinary zlib
+# stream; a private opBK chunk records the block size so readers can start inflating at any block.
+BYTES_PER_PIXEL = 3
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+COMPRESS_LEVEL = 6            # Same default as Pillow
+BLOCK_SIZE = 1 << 20          # Scanline bytes per independently deflated IDAT block
+INFLATE_CHUNK_SIZE = 1 << 20  # Upper bound on filtered bytes inflated per step while reading
+ZLIB_HEADER = b'\x78\x9c'
+BLOCK_CHUNK = b'opBK'         # Private, ancillary, unsafe to copy: dropped by editors that re-encode IDAT
+_COLOR_TYPE_RGB = 2
+
+
+def _import_pil():
+    try:
+        from PIL import Image, UnidentifiedImageError
+    except ImportError:
+        raise CarrierError("Pillow is required for PNG support. Install it with 'pip install pillow'.") from None
+    return Image, UnidentifiedImageError
+
+
+def image_size_for(payload_len, target_dims=None):
+    # Returns (width, height) for a carrier: square-ish when target_dims is None, else target_dims if it fits.
+    required_pixels = math.ceil(payload_len / BYTES_PER_PIXEL)
+    if target_dims is None:
+        width = max(1, math.ceil(math.sqrt(required_pixels)))
+        height = max(1, math.ceil(required_pixels / width))
+        return width, height
+    width, height = target_dims
+    if required_pixels > width * height:
+        raise CarrierError(
+            f"Data ({required_pixels} pixels required) exceeds target image capacity ({width*height} pixels).")
+    return width, height
+
+
+def image_dimensions(path):
+    # Reads (width, height) from a PNG's IHDR chunk without decoding the image.
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(24)
+    except OSError as e:
+        raise CarrierError(f"Cannot read image '{path}': {e}") from None
+    if len(head) < 24 or head[:8] != PNG_SIGNATURE or head[12:16] != b'IHDR':
+        raise CarrierError(f"'{path}' is not a PNG image.")
+    return struct.unpack('>II', head[16:24])
+
+
+def _write_chunk(f, chunk_type, data):
+    f.write(struct.pack('>I', len(data)))
+    f.write(chunk_type)
+    f.write(data)
+    f.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(chunk_type))))
+
+
+def _deflate_block(block, level, last):
+    # Compresses one block as raw deflate, ending on a byte boundary (full flush) or with the final block.
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(block) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_FULL_FLUSH)
+
+
+class PngWriter(CarrierWriter):
+    # With workers > 1 the blocks are deflated concurrently (zlib releases the GIL), pigz-style.
+    # Every finished block ends on a byte boundary, so an interrupted image can be resumed by cutting
+    # the file after its last block and restoring the running Adler-32.
+    def __init__(self, path, payload_len, target_dims=None, compress_level=COMPRESS_LEVEL, workers=1, resume=None):
+        super().__init__(path, payload_len)
+        self.width, self.height = image_size_for(payload_len, target_dims)
+        self.row_bytes = self.width * BYTES_PER_PIXEL
+        self.compress_level = compress_level
+        self.workers = max(1, workers)
+        self._partial_row = b''
+        self._block = bytearray()
+        self._blocks = deque()
+        try:
+            if resume is not None:
+                self._reopen(resume)
+            else:
+                self._received = 0
+                self._skip = 0
+                self._blocks_done = 0
+                self._adler = zlib.adler32(b'')
+                self._f = open(path, 'wb')
+                self._f.write(PNG_SIGNATURE)
+                _write_chunk(self._f, b'IHDR', struct.pack('>IIBBBBB', self.width, self.height, 8, _COLOR_TYPE_RGB, 0, 0, 0))
+                _write_chunk(self._f, BLOCK_CHUNK, struct.pack('>I', BLOCK_SIZE))
+                _write_chunk(self._f, b'IDAT', ZLIB_HEADER)
+        except OSError as e:
+            raise CarrierError(f"Error creating image: {e}") from None
+        if self.workers > 1:
+            from concurrent.futures import ThreadPoolExecutor  # Deferred: it pulls in logging
+            self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        else:
+            self._executor = None
+
+    def _reopen(self, state):
+        if image_dimensions(self.path) != (self.width, self.height):
+            raise CarrierError(f"'{self.path}' does not match the interrupted encode; cannot resume.")
+        self._blocks_done = state['blocks']
+        self._adler = state['adler']
+        # Resume at the start of the scanline the last block ended in, dropping the part already written
+        rows, self._skip = divmod(self._blocks_done * BLOCK_SIZE, self.row_bytes + 1)
+        self._received = rows * self.row_bytes
+        self._f = reopen_truncated(self.path, state['file_offset'])
+
+    def pack(self, data):
+        # Cuts the bytes received so far into scanlines, each prefixed with filter type 0.
+        self._received += len(data)
+        if self._received > self.width * self.height * BYTES_PER_PIXEL:
+            raise CarrierError(f"Received {self._received} bytes for a {self.width}x{self.height} image.")
+        data = self._partial_row + data
+        whole = len(data) - len(data) % self.row_bytes
+        self._partial_row = data[whole:]
+        view = memoryview(data)
+        return b''.join(
+            b'\x00' + view[i:i + self.row_bytes] for i in range(0, whole, self.row_bytes)
+        )
+
+    def write_packed(self, scanlines):
+        if self._skip:
+            dropped = min(self._skip, len(scanlines))
+            scanlines = scanlines[dropped:]
+            self._skip -= dropped
+        self._block += scanlines
+        while len(self._block) >= BLOCK_SIZE:
+            self._submit(bytes(self._block[:BLOCK_SIZE]), last=False)
+            del self._block[:BLOCK_SIZE]
+
+    def _submit(self, block, last):
+        self._adler = zlib.adler32(block, self._adler)
+        self._blocks_done += 1
+        if self._executor is None:
+            _write_chunk(self._f, b'IDAT', _deflate_block(block, self.compress_level, last))
+            return
+        self._blocks.append(self._executor.submit(_deflate_block, block, self.compress_level, last))
+        # Keep a bounded number of blocks in flight, writing finished ones in order
+        while len(self._blocks) > 2 * self.workers:
+            _write_chunk(self._f, b'IDAT', self._blocks.popleft().result())
+
+    def checkpoint(self):
+        # Saves up to the last whole block. Scanline bytes still collecting in the next block are
+        # written again on resume.
+        while self._blocks:
+            _write_chunk(self._f, b'IDAT', self._blocks.popleft().result())
+        sync_file(self._f)
+        rows, _ = divmod(self._blocks_done * BLOCK_SIZE, self.row_bytes + 1)
+        state = {'blocks': self._blocks_done, 'adler': self._adler, 'file_offset': self._f.tell()}
+        return rows * self.row_bytes, state
+
+    def close(self):
+        try:
+            # Zero padding up to the last pixel, fed through in bounded pieces
+            padding = self.width * self.height * BYTES_PER_PIXEL - self._received
+            step = max(self.row_bytes, BLOCK_SIZE - BLOCK_SIZE % self.row_bytes)
+            while padding > 0:
+                n = min(step, padding)
+                self.write(bytes(n))
+                padding -= n
+            self._submit(bytes(self._block), last=True)
+            self._block = bytearray()
+            while self._blocks:
+                _write_chunk(self._f, b'IDAT', self._blocks.popleft().result())
+            _write_chunk(self._f, b'IDAT', struct.pack('>I', self._adler))
+            _write_chunk(self._f, b'IEND', b'')
+            self._f.close()
+        except OSError as e:
+            raise CarrierError(f"Error creating or saving image: {e}") from None
+        finally:
+            self.abort()
+
+    def abort(self):
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+        self._f.close()
+
+
+class PngReader(CarrierReader):
+    # Streams pixel bytes from a PNG in the Opaline layout (8-bit RGB, non-interlaced, filter type 0,
+    # with an opBK chunk): IDAT chunks are inflated a bounded amount at a time and can be entered at any block.
+    def __init__(self, path, f, width, height):
+        super().__init__(path)
+        self.width, self.height = width, height
+        self.row_bytes = width * BYTES_PER_PIXEL
+        self.block_size = None
+        self._f = f
+        self._decompressor = zlib.decompressobj()
+        self._compressed = b''
+        self._filtered = bytearray()
+        self._skip_filtered = 0
+        self._rows_left = height
+        self._out = bytearray()
+        self._idat_count = 0  # IDAT chunks fetched or skipped so far
+        self._idat_done = False
+        self._scan_to_idat()
+
+    def _chunk_header(self):
+        head = self._f.read(8)
+        if len(head) < 8:
+            raise CarrierError(f"'{self.path}' ends before its IEND chunk.")
+        return struct.unpack('>I4s', head)
+
+    def _scan_to_idat(self):
+        # Reads the chunks ahead of the first IDAT (picking up opBK) and leaves the file at that IDAT.
+        while True:
+            start = self._f.tell()
+            length, chunk_type = self._chunk_header()
+            if chunk_type == b'IDAT':
+                self._f.seek(start)
+                return
+            if chunk_type == b'IEND':
+                self._idat_done = True
+                return
+            if chunk_type == BLOCK_CHUNK and length == 4:
+                data = self._f.read(4)
+                crc = self._f.read(4)
+                if len(crc) == 4 and struct.unpack('>I', crc)[0] == zlib.crc32(data, zlib.crc32(chunk_type)):
+                    self.block_size = struct.unpack('>I', data)[0] or None
+            else:
+                self._f.seek(length + 4, 1)
+
+    def _next_idat(self):
+        # Returns the next IDAT chunk's data, or b'' once the image data has ended.
+        while not self._idat_done:
+            length, chunk_type = self._chunk_header()
+            data = self._f.read(length)
+            crc = self._f.read(4)
+            if len(data) < length or len(crc) < 4 or struct.unpack('>I', crc)[0] != zlib.crc32(data, zlib.crc32(chunk_type)):
+                raise CarrierError(f"Corrupted {chunk_type.decode('latin-1')} chunk in '{self.path}'.")
+            if chunk_type == b'IDAT':
+                self._idat_count += 1
+                return data
+            if chunk_type == b'IEND':
+                self._idat_done = True
+        return b''
+
+    def _skip_idat(self):
+        # Moves past the next IDAT chunk without reading it. Returns False at IEND.
+        while not self._idat_done:
+            length, chunk_type = self._chunk_header()
+            self._f.seek(length + 4, 1)
+            if chunk_type == b'IDAT':
+                self._idat_count += 1
+                return True
+            if chunk_type == b'IEND':
+                self._idat_done = True
+        return False
+
+    def _fill(self, size):
+        # Decodes rows until at least `size` pixel bytes are buffered or the image is exhausted.
+        line = self.row_bytes + 1
+        while len(self._out) < size and self._rows_left > 0:
+            if len(self._filtered) < line:
+                if not self._compressed:
+                    self._compressed = self._next_idat()
+                    if not self._compressed:
+                        raise CarrierError(f"'{self.path}' has less image data than its size implies.")
+                self._filtered += self._decompressor.decompress(self._compressed, INFLATE_CHUNK_SIZE)
+                self._compressed = self._decompressor.unconsumed_tail
+                if self._skip_filtered:
+                    n = min(self._skip_filtered, len(self._filtered))
+                    del self._filtered[:n]
+                    self._skip_filtered -= n
+                continue
+            rows = min(len(self._filtered) // line, self._rows_left)
+            if self._filtered[0:rows * line:line].count(0) != rows:
+                raise CarrierError(f"'{self.path}' has filtered scanlines, which Opaline carriers never use.")
+            for r in range(rows):
+                start = r * line
+                self._out += self._filtered[start + 1:start + line]
+            del self._filtered[:rows * line]
+            self._rows_left -= rows
+
+    def _read(self, size):
+        if size is None or size < 0:
+            size = self._rows_left * self.row_bytes + len(self._out)
+        self._fill(size)
+        data = bytes(self._out[:size])
+        del self._out[:size]
+        return data
+
+    def _seek(self, offset):
+        # Jumps to the block holding `offset` and inflates from there with a fresh raw inflater.
+        if self.block_size is None or offset >= self.width * self.height * BYTES_PER_PIXEL:
+            return False
+        row, col = divmod(offset, self.row_bytes)
+        scanline_offset = row * (self.row_bytes + 1)
+        block = scanline_offset // self.block_size
+        target_idat = block + 1  # IDAT 0 holds the zlib header
+        if target_idat < self._idat_count:
+            return False
+        while self._idat_count < target_idat:
+            if not self._skip_idat():
+                raise CarrierError(f"'{self.path}' has less image data than its size implies.")
+        self._decompressor = zlib.decompressobj(-15)
+        self._compressed = self._next_idat()
+        self._filtered = bytearray()
+        self._skip_filtered = scanline_offset - block * self.block_size
+        self._rows_left = self.height - row
+        self._out = bytearray()
+        if col:
+            self._fill(col)
+            del self._out[:col]
+        return True
+
+    def close(self):
+        self._f.close()
+
+
+class PillowPngReader(BufferedReader):
+    # Fallback for PNGs outside the Opaline layout (older carriers, palette, alpha, 16-bit, interlaced):
+    # decoded in memory.
+    def __init__(self, path):
+        Image, UnidentifiedImageError = _import_pil()
+        try:
+            img = Image.open(path)
+        except FileNotFoundError:
+            raise CarrierError(f"Image file not found at '{path}'") from None
+        except UnidentifiedImageError:
+            raise CarrierError(f"Cannot identify image file '{path}'. Is it a valid image format?") from None
+        try:
+            if img.mode != 'RGB':
+                converted = img.convert('RGB')
+                data = converted.tobytes()
+                converted.close()
+            else:
+                data = img.tobytes()
+            self.width, self.height = img.size
+        except Exception as e:
+            raise CarrierError(f"Error processing image data from '{path}': {e}") from None
+        finally:
+            img.close()
+        super().__init__(path, data)
+
+
+def open_png_reader(path):
+    # Streams PNGs written by PngWriter, recognised by their opBK chunk. Anything else, including PNGs
+    # saved by older Opaline versions through Pillow (which filters scanlines adaptively), is decoded by
+    # Pillow: its C unfiltering is far faster than doing it row by row in Python.
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        raise CarrierError(f"Image file not found at '{path}'") from None
+    except OSError as e:
+        raise CarrierError(f"Error opening image '{path}': {e}") from None
+    head = f.read(33)
+    if len(head) == 33 and head[:8] == PNG_SIGNATURE and head[12:16] == b'IHDR':
+        width, height, depth, color_type, _, _, interlace = struct.unpack('>IIBBBBB', head[16:29])
+        if depth == 8 and color_type == _COLOR_TYPE_RGB and interlace == 0:
+            reader = PngReader(path, f, width, height)
+            if reader.block_size is not None:
+                return reader
+    f.close()
+    return PillowPngReader(path)
+
+
+register_backend('png', PngWriter, open_png_reader)
@@ -0,0 +1,155 @@
+import os
+import json
+import time
+import hashlib
+
+from .carrier import CarrierError, CarrierWriter, open_writer
+from .payload import (
+    HEADER_LEN, SIZE_BYTES_LEN, MODE_ADDITIVE, CHUNK_SIZE, PayloadError,
+    open_header, seal_header, carrier_length, encode_stream,
+)
+
+# Resumable encoding. While a checkpointed encode runs, <output>.checkpoint holds a small JSON record:
+# the input's SHA-256 and size, the media type and writer parameters, the carrier's mode header (whose
+# key verifier checks the key on resume), and the writer's state at its last checkpoint (frames, blocks or bytes safely on disk).
+# Encoding the same input to the same output again continues from there. The record is removed once
+# the carrier is finished.
+CHECKPOINT_SUFFIX = '.checkpoint'
+CHECKPOINT_VERSION = 2
+CHECKPOINT_INTERVAL = 10.0  # Seconds between checkpoints
+DIGEST_CHUNK_SIZE = 1 << 20
+
+
+def checkpoint_path(output_path):
+    return output_path + CHECKPOINT_SUFFIX
+
+
+def input_digest(path):
+    # SHA-256 of a file, as hex. Ties a checkpoint to the exact input it was made from.
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(DIGEST_CHUNK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_checkpoint(output_path, digest):
+    # Returns the checkpoint record for `output_path` if one exists for an input with this digest, else None.
+    try:
+        with open(checkpoint_path(output_path), 'r') as f:
+            record = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(record, dict) or record.get('version') != CHECKPOINT_VERSION:
+        return None
+    if record.get('input_sha256') != digest:
+        return None
+    return record
+
+
+def discard_checkpoint(output_path):
+    try:
+        os.remove(checkpoint_path(output_path))
+    except FileNotFoundError:
+        pass
+
+
+def _save_record(output_path, record):
+    # Written to a temporary file and renamed over the old record, so a crash never leaves half a record.
+    path = checkpoint_path(output_path)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(record, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class _CheckpointingWriter(CarrierWriter):
+    # Passes carrier bytes through to `writer`, calling save() every `interval` seconds. save() runs in
+    # the thread calling write_packed(), so it never races the writer.
+    def __init__(self, writer, save, interval):
+        super().__init__(writer.path, writer.payload_len)
+        self.writer = writer
+        self._save = save
+        self._interval = interval
+        self._last_save = time.monotonic()
+
+    def pack(self, data):
+        return self.writer.pack(data)
+
+    def write_packed(self, packed):
+        self.writer.write_packed(packed)
+        if time.monotonic() - self._last_save >= self._interval:
+            self._save()
+            self._last_save = time.monotonic()
+
+
+def encode_resumable(src_path, media_type, output_path, key_str, mode=MODE_ADDITIVE, params=None, record=None,
+                     digest=None, chunk_size=CHUNK_SIZE, progress=None, pipelined=False,
+                     interval=CHECKPOINT_INTERVAL):
+    # Encodes the file at `src_path` into a `media_type` carrier at `output_path`, checkpointing as it goes.
+    # Pass a record from load_checkpoint() to resume: its mode header and writer parameters are used,
+    # updated with `params`, and `mode` is ignored. Returns the carrier offset the encode started from.
+    # On any exception, including KeyboardInterrupt, the partial output and checkpoint are kept.
+    file_size = os.path.getsize(src_path)
+    if digest is None:
+        digest = input_digest(src_path)
+
+    if record is not None:
+        record = dict(record)
+        if record['input_size'] != file_size or record['media_type'] != media_type:
+            raise PayloadError("The checkpoint does not match this input and media type.")
+        params = {**record['params'], **(params or {})}
+        header = bytes.fromhex(record['header'])
+        try:
+            open_header(header, key_str, encrypting=True)
+        except PayloadError:
+            raise PayloadError("The key does not match the one used for the interrupted encode.") from None
+        start = record['offset']
+        writer = open_writer(media_type, output_path, carrier_length(file_size), resume=record['writer'], **params)
+    else:
+        params = dict(params or {})
+        header, _ = seal_header(mode, key_str)
+        record = {
+            'version': CHECKPOINT_VERSION,
+            'input_sha256': digest,
+            'input_size': file_size,
+            'media_type': media_type,
+            'params': {k: v for k, v in params.items() if k != 'workers'},
+            'header': header.hex(),
+        }
+        start = 0
+        # A checkpoint left by an earlier encode no longer describes the output once it is rewritten
+        discard_checkpoint(output_path)
+        writer = open_writer(media_type, output_path, carrier_length(file_size), **params)
+
+    def save():
+        saved = writer.checkpoint()
+        if saved is None or saved[0] < HEADER_LEN:
+            return  # Nothing past the mode header is on disk yet
+        record['offset'], record['writer'] = saved
+        _save_record(output_path, record)
+
+    try:
+        if start == 0:
+            writer.write(header)
+        body_start = max(0, start - HEADER_LEN)
+        with open(src_path, 'rb') as src:
+            src.seek(max(0, body_start - SIZE_BYTES_LEN))
+            encode_stream(src, file_size, _CheckpointingWriter(writer, save, interval), key_str,
+                          chunk_size=chunk_size, progress=progress, pipelined=pipelined,
+                          header=header, start=body_start)
+        # Every carrier byte is with the writer; an interrupted close() only needs redoing
+        save()
+    except BaseException:
+        writer.suspend()
+        raise
+
+    try:
+        writer.close()
+    except CarrierError:
+        discard_checkpoint(output_path)
+        raise
+    discard_checkpoint(output_path)
+    return start
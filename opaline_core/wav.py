@@ -0,0 +1,115 @@
+import wave
+import struct
+
+from .carrier import CarrierError, CarrierWriter, CarrierReader, register_backend, sync_file, reopen_truncated
+
+DEFAULT_SAMPLE_RATE = 44100
+DEFAULT_SAMPLE_WIDTH = 2
+DEFAULT_CHANNELS = 2
+# Canonical 44-byte PCM header: RIFF chunk, fmt chunk and data chunk header. Written directly rather
+# than through the wave module so the full data length is on disk from the start.
+WAV_HEADER_FORMAT = '<4sI4s4sIHHIIHH4sI'
+WAV_HEADER_LEN = struct.calcsize(WAV_HEADER_FORMAT)
+WAVE_FORMAT_PCM = 1
+
+
+class WavWriter(CarrierWriter):
+    # Carrier bytes are written as raw PCM frames; the last frame is zero padded. The header is written
+    # with the final frame count up front, so an interrupted file can be resumed by appending frames.
+    def __init__(self, path, payload_len, sample_rate=DEFAULT_SAMPLE_RATE, sample_width=DEFAULT_SAMPLE_WIDTH,
+                 channels=DEFAULT_CHANNELS, resume=None):
+        super().__init__(path, payload_len)
+        if sample_width not in (1, 2) or channels < 1 or sample_rate <= 0:
+            raise CarrierError(
+                f"Invalid WAV parameters ({channels} channels, {sample_rate} Hz, {sample_width} bytes/sample).")
+        self.bytes_per_frame = channels * sample_width
+        self.nframes = -(-payload_len // self.bytes_per_frame)
+        data_len = self.nframes * self.bytes_per_frame
+        if WAV_HEADER_LEN + data_len > 0xFFFFFFFF:
+            raise CarrierError("Data is too large for a WAV file (4 GiB limit).")
+        header = struct.pack(WAV_HEADER_FORMAT, b'RIFF', WAV_HEADER_LEN - 8 + data_len, b'WAVE',
+                             b'fmt ', 16, WAVE_FORMAT_PCM, channels, sample_rate,
+                             sample_rate * self.bytes_per_frame, self.bytes_per_frame, sample_width * 8,
+                             b'data', data_len)
+        self._pending = b''
+        self._frames_written = resume['frames'] if resume is not None else 0
+        try:
+            if resume is not None:
+                with open(path, 'rb') as f:
+                    if f.read(WAV_HEADER_LEN) != header:
+                        raise CarrierError(f"'{path}' does not match the interrupted encode; cannot resume.")
+                self._f = reopen_truncated(path, WAV_HEADER_LEN + self._frames_written * self.bytes_per_frame)
+            else:
+                self._f = open(path, 'wb')
+                self._f.write(header)
+        except OSError as e:
+            raise CarrierError(f"Error writing WAV file: {e}") from None
+
+    def pack(self, data):
+        # Returns the whole frames available so far, holding back any partial frame.
+        data = self._pending + data
+        whole = len(data) - len(data) % self.bytes_per_frame
+        self._pending = data[whole:]
+        return data[:whole]
+
+    def write_packed(self, frames):
+        if frames:
+            self._f.write(frames)
+            self._frames_written += len(frames) // self.bytes_per_frame
+
+    def checkpoint(self):
+        sync_file(self._f)
+        return self._frames_written * self.bytes_per_frame, {'frames': self._frames_written}
+
+    def close(self):
+        try:
+            if self._pending:
+                self.write_packed(self._pending.ljust(self.bytes_per_frame, b'\x00'))
+                self._pending = b''
+            self._f.close()
+        except OSError as e:
+            raise CarrierError(f"Error writing WAV file: {e}") from None
+
+    def abort(self):
+        self._f.close()
+
+
+class WavReader(CarrierReader):
+    def __init__(self, path):
+        super().__init__(path)
+        try:
+            self._wf = wave.open(path, 'rb')
+        except FileNotFoundError:
+            raise CarrierError(f"WAV file not found at '{path}'") from None
+        except (OSError, EOFError, wave.Error) as e:
+            raise CarrierError(f"Error reading WAV file '{path}': {e}. Is it a valid WAV file?") from None
+        self.channels = self._wf.getnchannels()
+        self.sample_rate = self._wf.getframerate()
+        self.sample_width = self._wf.getsampwidth()
+        self._bytes_per_frame = self.channels * self.sample_width
+        self._pending = b''
+
+    def _read(self, size):
+        if size is None or size < 0:
+            data = self._pending + self._wf.readframes(self._wf.getnframes())
+            self._pending = b''
+            return data
+        if len(self._pending) < size:
+            needed = size - len(self._pending)
+            self._pending += self._wf.readframes(-(-needed // self._bytes_per_frame))
+        data, self._pending = self._pending[:size], self._pending[size:]
+        return data
+
+    def _seek(self, offset):
+        frame, skip = divmod(offset, self._bytes_per_frame)
+        if frame > self._wf.getnframes():
+            return False
+        self._wf.setpos(frame)
+        self._pending = self._wf.readframes(1)[skip:] if skip else b''
+        return True
+
+    def close(self):
+        self._wf.close()
+
+
+register_backend('wav', WavWriter, WavReader)
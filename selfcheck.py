@@ -0,0 +1,369 @@
+import os
+import sys
+import random
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import opaline_core
+from opaline_core import MODE_ADDITIVE, MODE_KEYSTREAM, CarrierError, PayloadError, Engine
+
+# Correctness checks for the codec core. Run with: python selfcheck.py
+# Every check prints ok or FAILED and the script exits non-zero if any failed. Nothing here depends on
+# how fast the machine is; timings live in benchmark.py.
+
+CONCURRENT_JOBS = 48     # PNG/WAV round-trips run at once on one engine
+CONCURRENT_THREADS = 16
+CONCURRENT_MAX_SIZE = 3 * 1024 * 1024
+RESUME_SIZE = 6 * 1024 * 1024
+RESUME_CHUNK_SIZE = 1 << 20
+SEEK_SIZE = 5 * 1024 * 1024  # Spans several PNG blocks
+MP4_PARAMS = {'width': 320, 'height': 240, 'fps': 10, 'segment_frames': 4}
+MP4_SIZE = 5 * 1024 * 1024   # About 20 frames, so several segments
+MP4_WORKERS = 3
+
+
+class _Interrupted(Exception):
+    pass
+
+
+def _random_file(path, size, seed):
+    data = random.Random(seed).randbytes(size)
+    with open(path, 'wb') as f:
+        f.write(data)
+    return data
+
+
+def _read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _result(name, problems):
+    return name, not problems, '; '.join(problems)
+
+
+def _round_trip(engine, tmp, index):
+    # Encodes and decodes one random file. Returns a problem, or None if the output matches and each
+    # job's own progress ended at its own total, i.e. no state leaked between concurrent jobs.
+    rng = random.Random(index)
+    media_type = ('png', 'wav')[index % 2]
+    mode, key = ((MODE_ADDITIVE, f"{index % 256:02X} 5A C3"), (MODE_KEYSTREAM, f"stress {index}"))[index // 2 % 2]
+    src_path = os.path.join(tmp, f"in{index}.bin")
+    carrier_path = os.path.join(tmp, f"carrier{index}.{media_type}")
+    out_path = os.path.join(tmp, f"out{index}.bin")
+    data = _random_file(src_path, rng.randrange(1, CONCURRENT_MAX_SIZE), index)
+
+    seen = []
+    encode_job = engine.encode(src_path, media_type, carrier_path, key, mode, progress=lambda d, t: seen.append(t))
+    decode_job = engine.decode(carrier_path, media_type, out_path, key)
+    carrier_total = opaline_core.carrier_length(len(data))
+    if _read_file(out_path) != data:
+        return f"job {index} ({media_type}) output differs"
+    if decode_job.written != len(data) or decode_job.done != len(data):
+        return f"job {index} decode progress is off"
+    if encode_job.done != carrier_total or encode_job.total != carrier_total or set(seen) != {carrier_total}:
+        return f"job {index} encode progress is off"
+    return None
+
+
+def check_concurrent_round_trips(tmp):
+    engine = Engine(pipelined=True, png_workers=2)
+    with ThreadPoolExecutor(max_workers=CONCURRENT_THREADS) as pool:
+        outcomes = list(pool.map(lambda i: _round_trip(engine, tmp, i), range(CONCURRENT_JOBS)))
+    problems = [p for p in outcomes if p is not None]
+    return _result(f"{CONCURRENT_JOBS} concurrent round-trips", problems)
+
+
+def check_archive(tmp):
+    # Packs a folder, lists it, extracts one member and then all of them.
+    src = os.path.join(tmp, "folder")
+    files = {"a.txt": 1000, "sub/b.bin": 1500 * 1024, "sub/deeper/empty": 0, "ünïcode.txt": 77}
+    contents = {}
+    for seed, (name, size) in enumerate(files.items()):
+        path = os.path.join(src, *name.split('/'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        contents[name] = _random_file(path, size, seed)
+
+    engine = Engine()
+    problems = []
+    for media_type in ('png', 'wav'):
+        carrier = os.path.join(tmp, f"archive.{media_type}")
+        engine.encode_directory(src, media_type, carrier, "archive", MODE_KEYSTREAM)
+        names = [m.name for m in engine.list_archive(carrier, media_type, "archive")]
+        if sorted(names) != sorted(contents):
+            problems.append(f"{media_type}: listed {names}")
+
+        one = os.path.join(tmp, f"one_{media_type}")
+        engine.extract(carrier, media_type, "archive", one, ["sub/b.bin"])
+        extracted = [os.path.relpath(os.path.join(root, f), one).replace(os.sep, '/')
+                     for root, _, found in os.walk(one) for f in found]
+        if extracted != ["sub/b.bin"] or _read_file(os.path.join(one, "sub", "b.bin")) != contents["sub/b.bin"]:
+            problems.append(f"{media_type}: single-member extraction gave {extracted}")
+
+        every = os.path.join(tmp, f"all_{media_type}")
+        engine.extract(carrier, media_type, "archive", every)
+        for name, data in contents.items():
+            if _read_file(os.path.join(every, *name.split('/'))) != data:
+                problems.append(f"{media_type}: '{name}' differs after extracting everything")
+
+        try:
+            engine.extract(carrier, media_type, "archive", every, ["missing.txt"])
+            problems.append(f"{media_type}: extracting a missing member did not fail")
+        except PayloadError:
+            pass
+    return _result("archive extraction", problems)
+
+
+def _interrupting_progress(after):
+    calls = []
+    def progress(done, total):
+        calls.append(done)
+        if len(calls) == after:
+            raise _Interrupted()
+    return progress
+
+
+def check_resume(tmp):
+    # Interrupts encodes part way, resumes them and compares the result with an uninterrupted encode.
+    # Additive carriers are deterministic, so those must match byte for byte; keystream ones get a
+    # fresh salt, so they are compared after decoding.
+    src = os.path.join(tmp, "input.bin")
+    data = _random_file(src, RESUME_SIZE, 1)
+    digest = opaline_core.input_digest(src)
+    cases = [
+        ('png', MODE_ADDITIVE, "0A 1B", "0A 1C", {'workers': 2}, False),
+        ('png', MODE_KEYSTREAM, "resume", "Resume", {}, True),
+        ('wav', MODE_ADDITIVE, "5C", "5D", {}, True),
+        ('wav', MODE_KEYSTREAM, "resume", "Resume", {}, False),
+    ]
+    problems = []
+    for media_type, mode, key, wrong, params, pipelined in cases:
+        label = f"{media_type}/{'keystream' if mode == MODE_KEYSTREAM else 'additive'}"
+        reference = os.path.join(tmp, f"reference.{media_type}")
+        output = os.path.join(tmp, f"resumed.{media_type}")
+        opaline_core.encode_resumable(src, media_type, reference, key, mode, params, digest=digest,
+                                      chunk_size=RESUME_CHUNK_SIZE, pipelined=pipelined)
+        try:
+            opaline_core.encode_resumable(src, media_type, output, key, mode, params, digest=digest,
+                                          chunk_size=RESUME_CHUNK_SIZE, progress=_interrupting_progress(3),
+                                          pipelined=pipelined, interval=0)
+            problems.append(f"{label}: the encode was not interrupted")
+            continue
+        except _Interrupted:
+            pass
+
+        record = opaline_core.load_checkpoint(output, digest)
+        if record is None or not record.get('offset'):
+            problems.append(f"{label}: no checkpoint was left behind")
+            continue
+        try:
+            opaline_core.encode_resumable(src, media_type, output, wrong, mode, params, record=record, digest=digest)
+            problems.append(f"{label}: resuming with the wrong key did not fail")
+        except PayloadError:
+            pass
+        start = opaline_core.encode_resumable(src, media_type, output, key, mode, params, record=record,
+                                              digest=digest, chunk_size=RESUME_CHUNK_SIZE, pipelined=pipelined)
+        if start != record['offset']:
+            problems.append(f"{label}: resumed from {start}, not the checkpoint's {record['offset']}")
+        if os.path.exists(opaline_core.checkpoint_path(output)):
+            problems.append(f"{label}: the checkpoint was not removed")
+        if mode == MODE_ADDITIVE and _read_file(output) != _read_file(reference):
+            problems.append(f"{label}: the resumed carrier differs from an uninterrupted one")
+        recovered = os.path.join(tmp, "recovered.bin")
+        Engine().decode(output, media_type, recovered, key)
+        if _read_file(recovered) != data:
+            problems.append(f"{label}: the resumed carrier does not decode to the input")
+    return _result("resume after interruption", problems)
+
+
+def check_declined_resume(tmp):
+    # An encode is interrupted, the resume offer is declined and the fresh encode is interrupted before
+    # its first checkpoint. The old checkpoint must be gone, and the old record must not resume onto the
+    # rewritten (shorter) output.
+    src = os.path.join(tmp, "input.bin")
+    data = _random_file(src, RESUME_SIZE, 6)
+    digest = opaline_core.input_digest(src)
+    problems = []
+    for media_type in ('png', 'wav'):
+        output = os.path.join(tmp, f"declined.{media_type}")
+        try:
+            opaline_core.encode_resumable(src, media_type, output, "first", MODE_KEYSTREAM, digest=digest,
+                                          chunk_size=RESUME_CHUNK_SIZE, progress=_interrupting_progress(5),
+                                          interval=0)
+        except _Interrupted:
+            pass
+        stale = opaline_core.load_checkpoint(output, digest)
+        if stale is None:
+            problems.append(f"{media_type}: the first encode left no checkpoint")
+            continue
+
+        try:
+            opaline_core.encode_resumable(src, media_type, output, "second", MODE_KEYSTREAM, digest=digest,
+                                          chunk_size=RESUME_CHUNK_SIZE, progress=_interrupting_progress(1))
+        except _Interrupted:
+            pass
+        if opaline_core.load_checkpoint(output, digest) is not None:
+            problems.append(f"{media_type}: the declined checkpoint survived a fresh encode")
+        try:
+            opaline_core.encode_resumable(src, media_type, output, "first", record=stale, digest=digest)
+            problems.append(f"{media_type}: a stale checkpoint resumed onto a rewritten output")
+        except CarrierError:
+            pass
+
+        opaline_core.encode_resumable(src, media_type, output, "second", MODE_KEYSTREAM, digest=digest)
+        recovered = os.path.join(tmp, "recovered.bin")
+        Engine().decode(output, media_type, recovered, "second")
+        if _read_file(recovered) != data:
+            problems.append(f"{media_type}: the final encode does not decode to the input")
+    return _result("declined resume", problems)
+
+
+def check_png_reading(tmp):
+    # Seeks into a multi-block PNG carrier, and reads a PNG re-saved by Pillow through the fallback.
+    src = os.path.join(tmp, "input.bin")
+    _random_file(src, SEEK_SIZE, 2)
+    carrier = os.path.join(tmp, "seek.png")
+    Engine(png_workers=2).encode(src, 'png', carrier, "seek", MODE_KEYSTREAM)
+    with opaline_core.open_reader('png', carrier) as reader:
+        full = reader.read()
+
+    problems = []
+    rng = random.Random(3)
+    block = 1 << 20
+    candidates = sorted({0, block - 1, block + 100, 3 * block + 5, len(full) - 10} | {rng.randrange(len(full)) for _ in range(8)})
+    # One reader only seeks forward, so each offset must lie past the previous read
+    offsets = [o for i, o in enumerate(candidates) if i == 0 or o >= candidates[i - 1] + 100]
+    with opaline_core.open_reader('png', carrier) as reader:
+        if getattr(reader, 'block_size', None) is None:
+            problems.append("the carrier was not read by the streaming reader")
+        for offset in offsets:
+            reader.seek(offset)
+            if reader.read(100) != full[offset:offset + 100]:
+                problems.append(f"seek to {offset} read the wrong bytes")
+    for offset in offsets[::3]:
+        with opaline_core.open_reader('png', carrier) as reader:
+            reader.seek(offset)
+            if reader.read(100) != full[offset:offset + 100]:
+                problems.append(f"fresh seek to {offset} read the wrong bytes")
+
+    try:
+        from PIL import Image
+    except ImportError:
+        problems.append("Pillow is not installed")
+    else:
+        resaved = os.path.join(tmp, "resaved.png")
+        with Image.open(carrier) as img:
+            img.save(resaved)
+        with opaline_core.open_reader('png', resaved) as reader:
+            if type(reader).__name__ != 'PillowPngReader' or reader.read() != full:
+                problems.append("a PNG re-saved by Pillow did not read back through the fallback")
+    return _result("PNG seeking and fallback", problems)
+
+
+def check_mp4_round_trip(tmp):
+    # Segmented MP4: concat join, per-segment decoding with -ss, seeking into a later segment and
+    # resuming an interrupted encode. Skipped without ffmpeg.
+    from opaline_core.mp4 import ffmpeg_available
+    if not ffmpeg_available():
+        return None
+    src = os.path.join(tmp, "input.bin")
+    data = _random_file(src, MP4_SIZE, 5)
+    engine = Engine(mp4_workers=MP4_WORKERS)
+    carrier = os.path.join(tmp, "carrier.mp4")
+    recovered = os.path.join(tmp, "recovered.bin")
+    problems = []
+
+    engine.encode(src, 'mp4', carrier, "video", MODE_KEYSTREAM, MP4_PARAMS)
+    engine.decode(carrier, 'mp4', recovered, "video")
+    if _read_file(recovered) != data:
+        problems.append("the decoded file differs from the input")
+
+    with opaline_core.open_reader('mp4', carrier, workers=1) as reader:
+        full = reader.read()
+    with opaline_core.open_reader('mp4', carrier, workers=MP4_WORKERS) as reader:
+        if reader._segments is None or len(reader._segments) < 3:
+            problems.append("the carrier was not read as a segmented MP4")
+        else:
+            for offset in (reader._segment_bytes * 2 + 12345, reader.video_capacity - 50):
+                reader.seek(offset)
+                if reader.read(100) != full[offset:offset + 100]:
+                    problems.append(f"seek to {offset} read the wrong bytes")
+
+    resumed = os.path.join(tmp, "resumed.mp4")
+    digest = opaline_core.input_digest(src)
+    try:
+        opaline_core.encode_resumable(src, 'mp4', resumed, "video", MODE_KEYSTREAM,
+                                      {**MP4_PARAMS, 'workers': MP4_WORKERS}, digest=digest,
+                                      chunk_size=RESUME_CHUNK_SIZE, progress=_interrupting_progress(3), interval=0)
+        problems.append("the MP4 encode was not interrupted")
+    except _Interrupted:
+        record = opaline_core.load_checkpoint(resumed, digest)
+        if record is None:
+            problems.append("no MP4 checkpoint was left behind")
+        else:
+            engine.encode(src, 'mp4', resumed, "video", record=record, digest=digest)
+            engine.decode(resumed, 'mp4', recovered, "video")
+            if _read_file(recovered) != data:
+                problems.append("the resumed MP4 does not decode to the input")
+    return _result("segmented MP4 round-trip", problems)
+
+
+def check_bad_carriers(tmp):
+    # A wrong key and a truncated carrier must fail cleanly and leave no output behind.
+    src = os.path.join(tmp, "input.bin")
+    _random_file(src, 200 * 1024, 4)
+    engine = Engine()
+    problems = []
+    for media_type in ('png', 'wav'):
+        for mode, key, wrong in ((MODE_ADDITIVE, "0A 0B", "0A 0C"), (MODE_KEYSTREAM, "right", "wrong")):
+            carrier = os.path.join(tmp, f"carrier.{media_type}")
+            out = os.path.join(tmp, "out.bin")
+            engine.encode(src, media_type, carrier, key, mode)
+            try:
+                engine.decode(carrier, media_type, out, wrong)
+                problems.append(f"{media_type}: a wrong key decoded")
+            except PayloadError:
+                if os.path.exists(out):
+                    problems.append(f"{media_type}: a wrong key left output behind")
+
+    carrier = os.path.join(tmp, "carrier.png")
+    truncated = os.path.join(tmp, "truncated.png")
+    with open(truncated, 'wb') as f:
+        f.write(_read_file(carrier)[:os.path.getsize(carrier) // 2])
+    try:
+        engine.decode(truncated, 'png', out, "right")
+        problems.append("a truncated PNG decoded")
+    except (CarrierError, PayloadError):
+        if os.path.exists(out):
+            problems.append("a truncated PNG left output behind")
+    return _result("wrong keys and damaged carriers", problems)
+
+
+def main():
+    checks = [
+        check_concurrent_round_trips,
+        check_archive,
+        check_resume,
+        check_declined_resume,
+        check_png_reading,
+        check_mp4_round_trip,
+        check_bad_carriers,
+    ]
+
+    failed = False
+    for check in checks:
+        with tempfile.TemporaryDirectory() as tmp:
+            try:
+                result = check(tmp)
+            except Exception as e:
+                result = check.__name__, False, f"{type(e).__name__}: {e}"
+        if result is None:
+            print(f"{check.__name__:<34} skipped (a required tool is missing)")
+            continue
+        name, ok, detail = result
+        print(f"{name:<34} {'ok' if ok else 'FAILED'} {detail}".rstrip())
+        failed = failed or not ok
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()